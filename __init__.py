@@ -15,5 +15,14 @@ def register():
         product.ProductProductAttribute,
         product.Template,
         product.Product,
+        product.ApplyAttributeSetStart,
+        product.ApplyAttributeSetValue,
+        product.Company,
+        product.Lang,
+        product.Cron,
         module=module, type_='model'
     )
+    Pool.register(
+        product.ApplyAttributeSet,
+        module=module, type_='wizard'
+    )
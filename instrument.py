@@ -0,0 +1,160 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+from trytond import backend
+from trytond.config import config
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+# Context key enabling the instrumentation for a call
+CONTEXT_KEY = 'product_attribute_instrument'
+
+
+class _QueryFilter(logging.Filter):
+    "Count the queries logged by the backend in the current thread"
+
+    def __init__(self, local, level):
+        super().__init__()
+        self._local = local
+        self.level = level
+
+    def filter(self, record):
+        if self._local.counting:
+            self._local.queries += 1
+        return record.levelno >= self.level
+
+
+class _Local(threading.local):
+    "Operations being measured and query count of the current thread"
+
+    def __init__(self):
+        self.frames = []
+        self.queries = 0
+        self.counting = 0
+
+
+class Instrumentation:
+    """
+    Collect wall time, query, row and render counts of attribute operations
+
+    The operations are measured only when the context key
+    product_attribute_instrument or the configuration option instrument of
+    the product_attribute_strict section is set. The option is read once.
+    The totals are kept per operation in stats and each call is logged.
+    """
+
+    def __init__(self):
+        self._local = _Local()
+        self._lock = threading.Lock()
+        self._installed = 0
+        self._filter = None
+        self._configured = None
+        self.stats = defaultdict(Counter)
+
+    def enabled(self):
+        context = Transaction().context
+        if CONTEXT_KEY in context:
+            return bool(context[CONTEXT_KEY])
+        if self._configured is None:
+            self._configured = config.getboolean(
+                'product_attribute_strict', 'instrument', default=False)
+        return self._configured
+
+    @property
+    def active(self):
+        "Whether the current thread is measuring an operation"
+        return bool(self._local.frames)
+
+    def reset(self):
+        self.stats.clear()
+
+    def measure(self, name):
+        "Return a context manager measuring the operation name"
+        if not self.enabled():
+            return nullcontext()
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name):
+        state = self._local
+        counts = Counter()
+        state.frames.append(counts)
+        start = time.perf_counter()
+        try:
+            with self.count_queries() as queries:
+                yield counts
+        finally:
+            state.frames.pop()
+            counts['calls'] += 1
+            counts['time'] += time.perf_counter() - start
+            counts['queries'] += queries.count
+            self.stats[name].update(counts)
+            logger.info('%s: %.3fs, %s queries, %s rows, %s renders',
+                name, counts['time'], counts['queries'], counts['rows'],
+                counts['renders'])
+
+    def add(self, **counts):
+        "Add the counts to all the operations being measured"
+        for frame in self._local.frames:
+            frame.update(counts)
+
+    @contextmanager
+    def count_queries(self):
+        "Count the queries executed by the current thread"
+        state = self._local
+        result = _QueryCount()
+        start = state.queries
+        state.counting += 1
+        if state.counting == 1:
+            self._install()
+        try:
+            yield result
+        finally:
+            if state.counting == 1:
+                self._uninstall()
+            state.counting -= 1
+            result.count = state.queries - start
+
+    def _count(self, query):
+        self._local.queries += 1
+
+    def _install(self):
+        if backend.name == 'sqlite':
+            Transaction().connection.set_trace_callback(self._count)
+            return
+        backend_logger = logging.getLogger(
+            'trytond.backend.%s.database' % backend.name)
+        with self._lock:
+            if not self._installed:
+                self._filter = _QueryFilter(
+                    self._local, backend_logger.getEffectiveLevel())
+                self._level = backend_logger.level
+                backend_logger.addFilter(self._filter)
+                backend_logger.setLevel(logging.DEBUG)
+            self._installed += 1
+
+    def _uninstall(self):
+        if backend.name == 'sqlite':
+            Transaction().connection.set_trace_callback(None)
+            return
+        backend_logger = logging.getLogger(
+            'trytond.backend.%s.database' % backend.name)
+        with self._lock:
+            self._installed -= 1
+            if not self._installed:
+                backend_logger.setLevel(self._level)
+                backend_logger.removeFilter(self._filter)
+                self._filter = None
+
+
+class _QueryCount:
+    count = 0
+
+
+instrumentation = Instrumentation()
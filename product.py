@@ -1,18 +1,50 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime as dt
+import logging
+import multiprocessing
+import os
+import threading
+from collections import defaultdict
+from itertools import islice
+from decimal import Decimal, InvalidOperation
+
 import pytz
-from trytond.model import ModelSQL, ModelView, fields
+from sql import Column, Literal, Null, Union
+from sql.aggregate import Count
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp, Floor
+from sql.operators import Exists
+from trytond import backend
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.ir.lang import NO_BREAKING_SPACE
+from trytond.model import Index, ModelSQL, ModelStorage, ModelView, fields
+from trytond.model.exceptions import (
+    RequiredValidationError, ValidationError)
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, If, Bool, Not
-from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction, record_cache_size
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+from . import snapshot
+from .instrument import instrumentation
 
 try:
-    from jinja2 import Template as Jinja2Template
+    from jinja2 import nodes
+    from jinja2.exceptions import TemplateSyntaxError
+    from jinja2.sandbox import SandboxedEnvironment
     jinja2_loaded = True
 except ImportError:
     jinja2_loaded = False
 
 
+logger = logging.getLogger(__name__)
+
 ATTRIBUTE_TYPES = [
     ('boolean', 'Boolean'),
     ('integer', 'Integer'),
@@ -23,20 +55,280 @@ ATTRIBUTE_TYPES = [
     ('datetime', 'DateTime'),
     ('selection', 'Selection'),
 ]
+# Fields of product.product.attribute from which the search value is computed
+VALUE_FIELDS = {'attribute', 'value_selection', 'value_datetime',
+    'value_date', 'value_char', 'value_numeric', 'value_float',
+    'value_boolean', 'value_integer'}
+EPOCH = dt.datetime(1970, 1, 1)
+
+
+def parse_boolean(value):
+    value = value.strip().lower()
+    if value in {'1', 'true', 't', 'yes', 'y'}:
+        return True
+    elif value in {'', '0', 'false', 'f', 'no', 'n'}:
+        return False
+    raise ValueError(value)
+
+
+# Parsers of the text values by attribute type, selection excepted
+VALUE_PARSERS = {
+    'boolean': parse_boolean,
+    'integer': int,
+    'char': str,
+    'float': float,
+    'numeric': Decimal,
+    'date': dt.date.fromisoformat,
+    'datetime': dt.datetime.fromisoformat,
+    }
+
+
+def parse_value(value):
+    "Return the typed value of a search operand given as text"
+    if isinstance(value, str):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            pass
+        for type_ in (dt.datetime, dt.date):
+            try:
+                return type_.fromisoformat(value)
+            except ValueError:
+                pass
+    return value
+
+
+def value_sort_key(value):
+    "Return the numeric sort key of the attribute value"
+    value = parse_value(value)
+    if isinstance(value, dt.datetime):
+        return (value.replace(tzinfo=None) - EPOCH).total_seconds()
+    elif isinstance(value, dt.date):
+        return (dt.datetime.combine(value, dt.time()) - EPOCH).total_seconds()
+    elif isinstance(value, (bool, int, float, Decimal)):
+        return float(value)
+
+
+def value_search_key(type_, value):
+    """
+    Return the normalized text and the sort key of the typed value
+
+    The value of selection attributes is the option name.
+    """
+    if type_ in {'selection', 'char'}:
+        return value, None
+    elif type_ == 'boolean':
+        value = bool(value)
+    if not type_ or value is None:
+        return None, None
+    return str(value), value_sort_key(value)
+
+
+def value_sort_types(value):
+    "Return the attribute types whose sort key is comparable with the value"
+    value = parse_value(value)
+    if isinstance(value, dt.date):
+        return ['date', 'datetime']
+    elif isinstance(value, bool):
+        return ['boolean']
+    elif isinstance(value, (int, float, Decimal)):
+        return ['integer', 'float', 'numeric']
+    return []
+
+
+class FormatTemplate:
+    "Template made only of literal text and variable substitutions"
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        # Sequence of (is_variable, text) pairs
+        self.parts = tuple(parts)
+
+    def render(self, values):
+        return ''.join(
+            str(values.get(text, '')) if is_variable else text
+            for is_variable, text in self.parts)
+
+
+class TemplateCache:
+    """
+    Size-bounded cache of compiled templates keyed by their source
+
+    The templates made only of literal text and variable substitutions are
+    compiled into FormatTemplate, the others into sandboxed Jinja templates.
+    """
+
+    def __init__(self, size_limit):
+        self._lock = threading.Lock()
+        self._templates = LRUDict(size_limit)
+        self._environment = None
+        self.hits = 0
+        self.misses = 0
 
-def datetime_to_company_tz(value):
-    pool = Pool()
-    Company = pool.get('company.company')
-    Lang = pool.get('ir.lang')
+    @property
+    def environment(self):
+        if self._environment is None:
+            self._environment = SandboxedEnvironment()
+        return self._environment
+
+    def _format_parts(self, source):
+        "Return the text and variable parts of the source if it is simple"
+        parts = []
+        for node in source.body:
+            if not isinstance(node, nodes.Output):
+                return
+            for child in node.nodes:
+                if isinstance(child, nodes.TemplateData):
+                    parts.append((False, child.data))
+                elif (isinstance(child, nodes.Name)
+                        and child.name not in self.environment.globals):
+                    parts.append((True, child.name))
+                else:
+                    return
+        return parts
+
+    def compile(self, expression):
+        source = self.environment.parse(expression)
+        parts = self._format_parts(source)
+        if parts is not None:
+            return FormatTemplate(parts)
+        return self.environment.from_string(source)
+
+    def get(self, expression):
+        with self._lock:
+            template = self._templates.get(expression)
+            if template is not None:
+                self._templates.move_to_end(expression)
+                self.hits += 1
+                return template
+            self.misses += 1
+        template = self.compile(expression)
+        with self._lock:
+            self._templates[expression] = template
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._templates),
+                }
+
+
+template_cache = TemplateCache(config.getint(
+        'product_attribute_strict', 'template_cache_size', default=1024))
+
+
+def _render_expression(job):
+    expression, values = job
+    return template_cache.get(expression).render(values)
+
+
+_render_pools = {}
+_render_pools_lock = threading.Lock()
+
+
+def render_pool(processes=None):
+    """
+    Return the process pool rendering the expressions or None to render them
+    serially
+
+    The number of processes defaults to the render_processes option. The pool
+    is started on first use and shared by the later calls of the process.
+    """
+    if processes is None:
+        processes = config.getint(
+            'product_attribute_strict', 'render_processes', default=1)
+    if processes > 1:
+        key = (os.getpid(), processes)
+        with _render_pools_lock:
+            pool = _render_pools.get(key)
+            if pool is None:
+                pool = _render_pools[key] = (
+                    multiprocessing.get_context('spawn').Pool(processes))
+            return pool
+
+
+class DatetimeFormatter:
+    """
+    Format UTC datetimes in the timezone of a company with the format of a
+    language
+
+    The timezone and format are resolved once per company and language and
+    the formatters are kept per timezone and format.
+    """
+    # Directives which need the calendar and formats of the language
+    _locale_directives = {'%A', '%a', '%B', '%b', '%p', '%x', '%X'}
+    _cache = Cache(
+        'product.attribute.datetime_formatter', context=False)
+    _formatters = LRUDict(64)
+
+    def __init__(self, timezone, format, lang_code):
+        self.timezone = pytz.timezone(timezone) if timezone else None
+        self.format = format
+        self.lang_code = lang_code
+        self.localized = any(
+            d in format for d in self._locale_directives)
+
+    @classmethod
+    def get(cls):
+        "Return the formatter of the company and language of the context"
+        pool = Pool()
+        Company = pool.get('company.company')
+        Lang = pool.get('ir.lang')
+        transaction = Transaction()
+
+        company_id = transaction.context.get('company')
+        key = (company_id, transaction.language)
+        args = cls._cache.get(key)
+        if args is None:
+            timezone = None
+            if company_id:
+                timezone = Company(company_id).timezone
+            lang = Lang.get()
+            args = (timezone, lang.date + ' %H:%M:%S', lang.code)
+            cls._cache.set(key, args)
+        args = tuple(args)
+        formatter = cls._formatters.get(args)
+        if formatter is None:
+            formatter = cls._formatters[args] = cls(*args)
+        return formatter
+
+    @classmethod
+    def clear(cls):
+        cls._cache.clear()
+
+    def __call__(self, value):
+        if self.timezone:
+            value = pytz.utc.localize(value).astimezone(self.timezone)
+        if self.localized:
+            Lang = Pool().get('ir.lang')
+            return Lang.get(self.lang_code).strftime(value, self.format)
+        return value.strftime(self.format).replace(' ', NO_BREAKING_SPACE)
 
-    company_id = Transaction().context.get('company')
-    if company_id:
-        company = Company(company_id)
-        if company.timezone:
-            timezone = pytz.timezone(company.timezone)
-            value = timezone.localize(value)
-            value = value + value.utcoffset()
-    return Lang.get().strftime(value)
+
+def datetime_to_company_tz(value):
+    return DatetimeFormatter.get()(value)
+
+
+def clear_record_cache(Model, ids=None):
+    "Invalidate the cached records of Model after an update in SQL"
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cache.values():
+        if Model.__name__ not in cache:
+            continue
+        if ids is None:
+            del cache[Model.__name__]
+        else:
+            cache_model = cache[Model.__name__]
+            for id_ in ids:
+                cache_model.pop(id_, None)
 
 
 class ProductAttributeSet(ModelSQL, ModelView):
@@ -57,11 +349,61 @@ class ProductAttributeSet(ModelSQL, ModelView):
         states={
             'invisible': Not(Eval('use_templates'))
         })
+    _attributes_cache = Cache(
+        'product.attribute.set.attributes', context=False)
 
     @staticmethod
     def default_use_templates():
         return False
 
+    @classmethod
+    def get_attributes_types(cls, set_id):
+        "Return the ordered attribute ids and types of the set"
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute-product.attribute-set')
+        attributes = cls._attributes_cache.get(set_id)
+        if attributes is None:
+            attributes = tuple(
+                (r['attribute'], r['attribute.']['type_'])
+                for r in AttributeSet.search_read([
+                        ('attribute_set', '=', set_id),
+                        ], order=[('id', 'ASC')],
+                    fields_names=['attribute', 'attribute.type_']))
+            cls._attributes_cache.set(set_id, attributes)
+        return attributes
+
+    @staticmethod
+    def clear_attributes_cache():
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        Attribute = pool.get('product.attribute')
+        AttributeSet._attributes_cache.clear()
+        Attribute._type_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        sets = super().create(vlist)
+        cls.clear_attributes_cache()
+        return sets
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Template = pool.get('product.template')
+        super().write(*args)
+        cls.clear_attributes_cache()
+        set_ids = []
+        actions = iter(args)
+        for sets, values in zip(actions, actions):
+            if 'use_templates' in values:
+                set_ids.extend(s.id for s in sets)
+        Template.set_attribute_sets_stale(set_ids)
+
+    @classmethod
+    def delete(cls, sets):
+        super().delete(sets)
+        cls.clear_attributes_cache()
+
     @staticmethod
     def template_context(record):
         User = Pool().get('res.user')
@@ -75,12 +417,16 @@ class ProductAttributeSet(ModelSQL, ModelView):
 
     def render_expression(self, expression, attributes):
         record = dict((x.attribute.name, x.value) for x in attributes)
-        template = Jinja2Template(expression)
-        return template.render(record)
+        return self.render_expression_record(expression, record)
 
     def render_expression_record(self, expression, record):
-        template = Jinja2Template(expression)
-        return template.render(record)
+        template = template_cache.get(expression)
+        # Renders are measured only inside a measured operation
+        if not instrumentation.active:
+            return template.render(record)
+        with instrumentation.measure('render_expression'):
+            instrumentation.add(renders=1)
+            return template.render(record)
 
 
 class AttributeSetFieldTemplate(ModelSQL, ModelView):
@@ -88,6 +434,7 @@ class AttributeSetFieldTemplate(ModelSQL, ModelView):
     __name__ = 'product.attribute.field_template'
 
     field_ = fields.Selection('get_field_selection', 'Field')
+    field_string = field_.translated('field_')
     jinja_template = fields.Text('jinja_template')
     attribute_set = fields.Many2One('product.attribute.set', 'Attribute Set')
 
@@ -98,6 +445,57 @@ class AttributeSetFieldTemplate(ModelSQL, ModelView):
             ('template,name', 'Name')
         ]
 
+    @classmethod
+    def validate(cls, field_templates):
+        super().validate(field_templates)
+        for field_template in field_templates:
+            field_template.check_jinja_template()
+
+    def check_jinja_template(self):
+        "Check the syntax of the template"
+        try:
+            template_cache.get(self.jinja_template or '')
+        except TemplateSyntaxError as exception:
+            raise ValidationError(gettext(
+                    'product_attribute_strict.msg_invalid_field_template',
+                    field=self.field_string or '',
+                    exception=exception)) from exception
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Template = pool.get('product.template')
+        field_templates = super().create(vlist)
+        Template.set_attribute_sets_stale(
+            {f.attribute_set.id for f in field_templates if f.attribute_set})
+        return field_templates
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Template = pool.get('product.template')
+        set_ids = set()
+        actions = iter(args)
+        for field_templates, values in zip(actions, actions):
+            set_ids.update(
+                f.attribute_set.id for f in field_templates
+                if f.attribute_set)
+            if values.get('attribute_set'):
+                set_ids.add(values['attribute_set'])
+        super().write(*args)
+        template_cache.clear()
+        Template.set_attribute_sets_stale(set_ids)
+
+    @classmethod
+    def delete(cls, field_templates):
+        pool = Pool()
+        Template = pool.get('product.template')
+        set_ids = {
+            f.attribute_set.id for f in field_templates if f.attribute_set}
+        super().delete(field_templates)
+        template_cache.clear()
+        Template.set_attribute_sets_stale(set_ids)
+
 
 class ProductAttributeSelectionOption(ModelSQL, ModelView):
     "Attribute Selection Option"
@@ -108,6 +506,80 @@ class ProductAttributeSelectionOption(ModelSQL, ModelView):
     attribute = fields.Many2One(
         "product.attribute", "Attribute", required=True, ondelete='CASCADE'
     )
+    _names_cache = Cache(
+        'product.attribute.selection_option.names', context=False)
+
+    @classmethod
+    def _get_names(cls, attribute_id):
+        key = (attribute_id, Transaction().language)
+        names = cls._names_cache.get(key)
+        if names is None:
+            options = cls.search_read([
+                    ('attribute', '=', attribute_id),
+                    ], order=[('id', 'ASC')], fields_names=['name'])
+            names = cls._names_cache.set(key, {
+                    'ids': {o['name']: o['id'] for o in options},
+                    'names': {o['id']: o['name'] for o in options},
+                    })
+        return names
+
+    @classmethod
+    def get_ids(cls, attribute_id):
+        "Return the option ids of the attribute by name"
+        return cls._get_names(attribute_id)['ids']
+
+    @classmethod
+    def get_names(cls, attribute_id):
+        "Return the option names of the attribute by id"
+        return cls._get_names(attribute_id)['names']
+
+    @classmethod
+    def upsert_options(cls, attribute, names):
+        """
+        Return the option ids of the attribute for the names
+
+        The missing options are created in one batch.
+        """
+        ids = cls.get_ids(attribute.id)
+        missing = list(dict.fromkeys(n for n in names if n not in ids))
+        if missing:
+            options = cls.create([{
+                        'attribute': attribute.id,
+                        'name': name,
+                        } for name in missing])
+            ids = {**ids, **{o.name: o.id for o in options}}
+        return [ids[n] for n in names]
+
+    @classmethod
+    def create(cls, vlist):
+        options = super().create(vlist)
+        cls._names_cache.clear()
+        return options
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        super().write(*args)
+        cls._names_cache.clear()
+        options = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'name' in values:
+                options.extend(records)
+        for sub_options in grouped_slice(
+                options, record_cache_size(Transaction())):
+            attributes = ProductAttribute.search([
+                    ('value_selection', 'in', [o.id for o in sub_options]),
+                    ])
+            ProductAttribute.sync_value_search(attributes)
+            ProductAttribute.set_templates_stale(attributes)
+            ProductAttribute.update_attribute_summary(attributes)
+
+    @classmethod
+    def delete(cls, options):
+        super().delete(options)
+        cls._names_cache.clear()
 
 
 class ProductAttribute(ModelSQL, ModelView):
@@ -131,6 +603,7 @@ class ProductAttribute(ModelSQL, ModelView):
             'invisible': ~(Eval('type_') == 'selection'),
         }
     )
+    _type_cache = Cache('product.attribute.type', context=False)
 
     def get_rec_name(self, name):
         return self.display_name or self.name
@@ -139,6 +612,69 @@ class ProductAttribute(ModelSQL, ModelView):
     def default_type_():
         return 'char'
 
+    @classmethod
+    def get_type(cls, attribute_id):
+        "Return the type of the attribute"
+        type_ = cls._type_cache.get(attribute_id)
+        if type_ is None:
+            type_ = cls(attribute_id).type_
+            cls._type_cache.set(attribute_id, type_)
+        return type_
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        attributes = super().create(vlist)
+        AttributeSet.clear_attributes_cache()
+        return attributes
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+        super().write(*args)
+        AttributeSet.clear_attributes_cache()
+        set_ids = set()
+        renamed = []
+        actions = iter(args)
+        for attributes, values in zip(actions, actions):
+            if 'name' in values:
+                set_ids.update(s.id for a in attributes for s in a.sets)
+            if {'name', 'display_name'} & values.keys():
+                renamed.extend(attributes)
+        Template.set_attribute_sets_stale(set_ids)
+        if renamed and Product.attribute_summary_enabled():
+            transaction = Transaction()
+            cursor = transaction.connection.cursor()
+            table = ProductAttribute.__table__()
+            product = Product.__table__()
+            product_ids = set()
+            for sub_ids in grouped_slice(
+                    [a.id for a in renamed], backend.MAX_QUERY_PARAMS):
+                where = reduce_ids(table.attribute, sub_ids)
+                cursor.execute(*Union(
+                        table.select(table.product,
+                            where=where & (table.product != Null)),
+                        product.join(table,
+                            condition=product.template == table.template
+                            ).select(product.id,
+                            where=where & (table.product == Null))))
+                product_ids.update(p for p, in cursor)
+            for sub_ids in grouped_slice(
+                    sorted(product_ids), record_cache_size(transaction)):
+                Product.update_attribute_summary(list(sub_ids))
+
+    @classmethod
+    def delete(cls, attributes):
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        super().delete(attributes)
+        AttributeSet.clear_attributes_cache()
+
 
 class ProductAttributeAttributeSet(ModelSQL):
     "Product Attribute - Set"
@@ -153,6 +689,37 @@ class ProductAttributeAttributeSet(ModelSQL):
         ondelete='CASCADE', required=True
     )
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.attribute_set, Index.Equality()),
+                (t.attribute, Index.Equality())))
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        records = super().create(vlist)
+        AttributeSet.clear_attributes_cache()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        super().write(*args)
+        AttributeSet.clear_attributes_cache()
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        super().delete(records)
+        AttributeSet.clear_attributes_cache()
+
 
 class Template(metaclass=PoolMeta):
     __name__ = 'product.template'
@@ -170,10 +737,20 @@ class Template(metaclass=PoolMeta):
         })
     use_templates = fields.Function(fields.Boolean('Use Templates'),
         'get_use_templates')
+    attributes_stale = fields.Boolean("Attributes Stale", readonly=True,
+        help="If checked, the fields rendered from the attributes "
+        "must be updated.")
+    attribute_values = fields.Function(fields.Dict(None, "Attribute Values"),
+        'get_attribute_values')
 
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.id, Index.Range()),
+                where=t.attributes_stale == Literal(True)))
         cls._buttons.update({
             'update_attributes_values': {
                 'invisible': ~Eval('use_templates'),
@@ -181,78 +758,387 @@ class Template(metaclass=PoolMeta):
                 }
             })
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        table_h = cls.__table_handler__(module_name)
+        fill_stale = not table_h.column_exist('attributes_stale')
+
+        super().__register__(module_name)
+
+        # Migration from 8.0: update all the templates once
+        if fill_stale:
+            cursor.execute(*table.update(
+                    [table.attributes_stale], [Literal(True)]))
+
+    @staticmethod
+    def default_attributes_stale():
+        return True
+
     @fields.depends('attribute_set', 'attributes')
     def on_change_attribute_set(self):
         pool = Pool()
+        Attribute = pool.get('product.attribute')
+        AttributeSet = pool.get('product.attribute.set')
         ProductAttribute = pool.get('product.product.attribute')
 
         if not self.attribute_set or not self.attribute_set.fill_on_selection:
             return
-        set_attributes = set(self.attribute_set.attributes)
-        product_attributes = set([x.attribute for x in self.attributes])
-
-        missing = set_attributes - product_attributes
-        exceeding = product_attributes - set_attributes
-
-        to_add = []
-        for attribute in self.attributes:
-            if attribute.attribute in exceeding:
+        set_attributes = AttributeSet.get_attributes_types(
+            self.attribute_set.id)
+        set_ids = {a for a, _ in set_attributes}
+        product_ids = {x.attribute.id for x in self.attributes if x.attribute}
+
+        to_add = [x for x in self.attributes
+            if x.attribute and x.attribute.id in set_ids]
+        for attribute_id, type_ in set_attributes:
+            if attribute_id in product_ids:
                 continue
-            to_add.append(attribute)
-        for attribute in missing:
             product_attribute = ProductAttribute()
-            product_attribute.attribute = attribute
-            product_attribute.attribute_type = attribute.type_
+            product_attribute.attribute = Attribute(attribute_id)
+            product_attribute.attribute_type = type_
             product_attribute.value = product_attribute.on_change_with_value()
             to_add.append(product_attribute)
         self.attributes = tuple(to_add)
 
+    @classmethod
+    def apply_attribute_set(cls, templates, attribute_set, values=None):
+        """
+        Set the attribute set of the templates, create their missing
+        attributes and delete those not in the set
+
+        values maps attribute ids to the values of the created attributes.
+        """
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        values = values or {}
+        set_attributes = AttributeSet.get_attributes_types(attribute_set.id)
+        set_ids = {a for a, _ in set_attributes}
+
+        for sub_templates in grouped_slice(
+                templates, backend.MAX_QUERY_PARAMS):
+            sub_templates = list(sub_templates)
+            template_ids = [t.id for t in sub_templates]
+            to_create, to_delete = [], []
+            existing = defaultdict(set)
+            for row in ProductAttribute.search_read([
+                        ('template', 'in', template_ids),
+                        ], fields_names=['template', 'product', 'attribute']):
+                if row['attribute'] not in set_ids:
+                    to_delete.append(row['id'])
+                elif not row['product']:
+                    existing[row['template']].add(row['attribute'])
+            for template_id in template_ids:
+                for attribute_id, _ in set_attributes:
+                    if attribute_id not in existing[template_id]:
+                        to_create.append({
+                                'template': template_id,
+                                'attribute': attribute_id,
+                                **values.get(attribute_id, {}),
+                                })
+
+            ProductAttribute.delete(ProductAttribute.browse(to_delete))
+            cls.write(sub_templates, {'attribute_set': attribute_set.id})
+            ProductAttribute.create(to_create)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+        table = ProductAttribute.__table__()
+
+        stale = []
+        actions = iter(args)
+        for templates, values in zip(actions, actions):
+            if 'attribute_set' not in values:
+                continue
+            stale.extend(t.id for t in templates)
+            for sub_ids in grouped_slice(
+                    [t.id for t in templates], backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.update(
+                        [table.template_attribute_set],
+                        [values['attribute_set']],
+                        where=reduce_ids(table.template, sub_ids)))
+        super().write(*args)
+        cls.set_attributes_stale(stale)
+
+    @classmethod
+    def set_attributes_stale(cls, template_ids, stale=True):
+        "Flag the templates whose rendered fields must be updated"
+        if not template_ids:
+            return
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice(template_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.update(
+                    [table.attributes_stale], [Literal(stale)],
+                    where=reduce_ids(table.id, sub_ids)))
+        clear_record_cache(cls, template_ids)
+
+    @classmethod
+    def set_attribute_sets_stale(cls, set_ids):
+        "Flag the templates of the attribute sets as stale"
+        if not set_ids:
+            return
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice(set_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*table.update(
+                    [table.attributes_stale], [Literal(True)],
+                    where=reduce_ids(table.attribute_set, sub_ids)))
+        clear_record_cache(cls)
+
+    @classmethod
+    def get_attribute_values(cls, templates, name=None):
+        "Return attribute name to typed value dictionaries per template id"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+
+        values = {t.id: {} for t in templates}
+        for sub_templates in grouped_slice(
+                templates, backend.MAX_QUERY_PARAMS):
+            for row, attribute, value in ProductAttribute.read_typed_values([
+                        ('template', 'in', [t.id for t in sub_templates]),
+                        ('product', '=', None),
+                        ]):
+                values[row['template']][attribute] = value
+        return values
+
     def get_use_templates(self, name):
         if self.attribute_set and self.attribute_set.use_templates:
             return True
         return False
 
+    @classmethod
+    def _get_attributes_values(cls, templates):
+        """
+        Return attribute name to value dictionaries per template id and per
+        product id
+        """
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+
+        template_values = defaultdict(dict)
+        product_values = defaultdict(dict)
+        for sub_templates in grouped_slice(
+                templates, backend.MAX_QUERY_PARAMS):
+            rows = ProductAttribute.search_read([
+                    ('template', 'in', [t.id for t in sub_templates]),
+                    ], order=[('id', 'ASC')],
+                fields_names=[
+                    'template', 'product', 'attribute.name', 'value'])
+            for row in rows:
+                if row['product']:
+                    values = product_values[row['product']]
+                else:
+                    values = template_values[row['template']]
+                values[row['attribute.']['name']] = row['value']
+        return template_values, product_values
+
     def _update_attributes_values(self):
+        """
+        Set the rendered fields on the template and its variants
+
+        Returns the variants to save. update_attributes_values renders the
+        templates in bulk with _render_attributes_values instead.
+        """
+        template_values, product_values = self._render_attributes_values(
+            [self])
+        for name, value in template_values.get(self, {}).items():
+            setattr(self, name, value)
         products_to_save = []
+        for product, values in product_values.items():
+            for name, value in values.items():
+                setattr(product, name, value)
+            products_to_save.append(product)
+        return products_to_save
 
-        if (not self.attribute_set or
-                not self.attribute_set.use_templates):
-            return products_to_save
+    @classmethod
+    def _render_attributes_values(cls, templates, process_pool=None):
+        """
+        Render the field templates of the attribute sets
+
+        The product fields are rendered with the attributes of the variant
+        merged over those of the template. Each distinct expression and
+        values is rendered only once, serially or with the process pool if
+        any.
+        The process pool renders the expressions with the template cache
+        and not with render_expression_record, so the overrides of that
+        method apply only to the serial rendering.
+        Returns the values to write on templates and on products as
+        dictionaries keyed by record. Records whose values do not change are
+        skipped.
+        """
+        template_values = defaultdict(dict)
+        product_values = defaultdict(dict)
+
+        templates = [t for t in templates
+            if t.attribute_set and t.attribute_set.use_templates]
+        template_attributes, product_attributes = (
+            cls._get_attributes_values(templates))
+        jobs, job_ids, targets = [], {}, []
+
+        def job(attribute_set, expression, values):
+            key = (attribute_set.id, expression, tuple(sorted(values.items())))
+            if key not in job_ids:
+                job_ids[key] = len(jobs)
+                jobs.append((attribute_set, expression, values))
+            return job_ids[key]
 
-        for product in self.products:
-            for field in self.attribute_set.jinja_templates:
+        for template in templates:
+            attribute_set = template.attribute_set
+            values = template_attributes.get(template.id, {})
+            for field in attribute_set.jinja_templates:
                 obj_name, name = field.field_.split(',')
-                obj = self
-                if obj_name == 'product' and product:
-                    obj = product
-                    products_to_save.append(product)
+                expression = field.jinja_template
+                if obj_name == 'product':
+                    # The product module computes the code of the variant
+                    # from the code of the template and the suffix code
+                    if name == 'code':
+                        name = 'suffix_code'
+                    for product in template.products:
+                        job_id = job(attribute_set, expression, {
+                                **values,
+                                **product_attributes.get(product.id, {}),
+                                })
+                        targets.append((product_values, product, name, job_id))
+                else:
+                    job_id = job(attribute_set, expression, values)
+                    targets.append((template_values, template, name, job_id))
+
+        if process_pool:
+            instrumentation.add(renders=len(jobs))
+            rendered = process_pool.map(_render_expression,
+                [(expression, values) for _, expression, values in jobs])
+        else:
+            rendered = [attribute_set.render_expression_record(
+                    expression, values)
+                for attribute_set, expression, values in jobs]
 
-                jinja_template = field.jinja_template
-                value = self.attribute_set.render_expression(
-                    jinja_template, self.attributes)
-                setattr(obj, name, value)
+        for record_values, record, name, job_id in targets:
+            value = record._fields[name].sql_format(rendered[job_id])
+            if getattr(record, name) != value:
+                record_values[record][name] = value
+        return template_values, product_values
 
-        return products_to_save
+    @staticmethod
+    def _group_values_to_write(record_values):
+        "Group records with the same values into write arguments"
+        groups = defaultdict(list)
+        for record, values in record_values.items():
+            groups[tuple(sorted(values.items()))].append(record)
+        to_write = []
+        for values, records in groups.items():
+            to_write.extend((records, dict(values)))
+        return to_write
 
     @classmethod
     @ModelView.button
     def update_attributes_values(cls, templates):
+        context = Transaction().context
+        queue = context.get('product_attribute_queue', config.getboolean(
+                'product_attribute_strict', 'queue_update', default=False))
+        if queue:
+            cls.queue_attributes_values(templates)
+        else:
+            cls.render_attributes_values(templates)
+
+    @classmethod
+    def queue_attributes_values(cls, templates, chunk_size=None):
+        """
+        Update the rendered fields of the templates by chunks in the queue
+
+        Each chunk is run and committed in its own task. The templates are
+        flagged as stale until their chunk succeeds and the failing tasks
+        are reported as errors.
+        """
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'product_attribute_strict', 'queue_chunk_size', default=100)
+        template_ids = [t.id for t in templates]
+        cls.set_attributes_stale(template_ids)
+        with Transaction().set_context(queue_name='product_attribute'):
+            for sub_ids in grouped_slice(template_ids, chunk_size):
+                cls.__queue__.render_attributes_values(
+                    cls.browse(list(sub_ids)))
+
+    @classmethod
+    def render_attributes_values(cls, templates, processes=None):
+        """
+        Render and write the fields of the templates from their attributes
+
+        The expressions are rendered by a pool of processes when processes
+        or the render_processes option is greater than 1.
+        """
         Product = Pool().get('product.product')
-        product_to_save = []
-        for template in templates:
-            product_to_save += template._update_attributes_values()
+        process_pool = render_pool(processes)
+        with instrumentation.measure('update_attributes_values'):
+            for sub_templates in grouped_slice(
+                    templates, record_cache_size(Transaction())):
+                sub_ids = [t.id for t in sub_templates]
+                template_values, product_values = (
+                    cls._render_attributes_values(
+                        cls.browse(sub_ids), process_pool=process_pool))
+                instrumentation.add(
+                    rows=len(template_values) + len(product_values))
+                if template_values:
+                    cls.write(*cls._group_values_to_write(template_values))
+                if product_values:
+                    Product.write(
+                        *cls._group_values_to_write(product_values))
+                cls.set_attributes_stale(sub_ids, stale=False)
 
-        cls.save(templates)
-        Product.save(product_to_save)
+    @classmethod
+    def update_stale_attributes_values(cls, templates=None):
+        "Update the rendered fields of the stale templates"
+        domain = [
+            ('attributes_stale', '=', True),
+            ('attribute_set.use_templates', '=', True),
+            ]
+        if templates is not None:
+            domain.append(('id', 'in', [t.id for t in templates]))
+        with Transaction().set_context(active_test=False):
+            cls.update_attributes_values(
+                cls.search(domain, order=[('id', 'ASC')]))
 
     @property
     def product_attribute_used(self):
-        # Skip rules to test pattern on all records
-        with Transaction().set_user(0):
-            template = self.__class__(self)
-        for attribute in template.attributes:
+        for _, attribute in self.product_attributes_used([self]):
             yield attribute
 
+    @classmethod
+    def product_attributes_used(cls, templates):
+        "Yield the template and attribute pairs of the templates"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = ProductAttribute.__table__()
+
+        for sub_templates in grouped_slice(
+                templates, record_cache_size(transaction)):
+            sub_templates = list(sub_templates)
+            cursor.execute(*table.select(table.template, table.id,
+                    where=reduce_ids(
+                        table.template, {t.id for t in sub_templates}),
+                    order_by=table.id))
+            template2ids = defaultdict(list)
+            for template_id, attribute_id in cursor:
+                template2ids[template_id].append(attribute_id)
+            # Skip rules to test pattern on all records
+            with transaction.set_user(0):
+                attributes = ProductAttribute.browse(
+                    [i for ids in template2ids.values() for i in ids])
+            id2attribute = {a.id: a for a in attributes}
+            for template in sub_templates:
+                for attribute_id in template2ids[template.id]:
+                    yield template, id2attribute[attribute_id]
+
     @classmethod
     def copy(cls, templates, default=None):
         pool = Pool()
@@ -264,20 +1150,21 @@ class Template(metaclass=PoolMeta):
 
         copy_attributes = 'attributes' not in default
         default.setdefault('attributes', None)
-        new_templates = super().copy(templates, default)
-        if copy_attributes:
-            old2new = {}
-            to_copy = []
-            for template, new_template in zip(templates, new_templates):
-                to_copy.extend(
-                    ps for ps in template.attributes if not ps.product)
-                old2new[template.id] = new_template.id
-            if to_copy:
-                ProductAttribute.copy(to_copy, {
-                        'template': lambda d: old2new[d['template']],
-                        })
+        default.setdefault('attributes_stale', True)
+        with instrumentation.measure('copy'):
+            new_templates = super().copy(templates, default)
+            if copy_attributes:
+                old2new = {}
+                to_copy = []
+                for template, new_template in zip(templates, new_templates):
+                    to_copy.extend(
+                        ps for ps in template.attributes if not ps.product)
+                    old2new[template.id] = new_template.id
+                if to_copy:
+                    ProductAttribute.copy_attributes(to_copy, old2new)
         return new_templates
 
+
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
 
@@ -293,6 +1180,10 @@ class Product(metaclass=PoolMeta):
 
     product_attribute_set = fields.Function(fields.Many2One(
         'product.attribute.set', 'Attribute Set'), 'get_product_attribute_set')
+    attribute_values = fields.Function(fields.Dict(None, "Attribute Values"),
+        'get_attribute_values')
+    attribute_summary = fields.Char("Attribute Summary", readonly=True,
+        help="The attributes of the variant and its template.")
 
     @classmethod
     def __setup__(cls):
@@ -302,9 +1193,108 @@ class Product(metaclass=PoolMeta):
                 'invisible': ~Eval('use_templates'),
                 'depends': ['attribute_set', 'use_templates']}})
 
+    @classmethod
+    def attribute_summary_enabled(cls):
+        context = Transaction().context
+        return context.get('product_attribute_summary', config.getboolean(
+                'product_attribute_strict', 'attribute_summary',
+                default=False))
+
+    @classmethod
+    def update_attribute_summary(cls, products):
+        """
+        Store the summary of the attributes of the products
+
+        The values are formatted in the default language and those of the
+        variant replace those of its template.
+        """
+        pool = Pool()
+        Configuration = pool.get('ir.configuration')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        if not products or not cls.attribute_summary_enabled():
+            return
+        with transaction.set_context(language=Configuration.get_language()):
+            products = cls.browse(products)
+            attributes = defaultdict(dict)
+            for product, attribute in cls.product_attributes_used(products):
+                attributes[product.id].setdefault(
+                    attribute.attribute.id, attribute)
+            to_update = defaultdict(list)
+            for product in products:
+                summary = ', '.join(
+                    '%s: %s' % (a.attribute.rec_name, a.value)
+                    for _, a in sorted(attributes[product.id].items())
+                    if a.value not in {None, ''}) or None
+                if product.attribute_summary != summary:
+                    to_update[summary].append(product.id)
+        for summary, product_ids in to_update.items():
+            for sub_ids in grouped_slice(
+                    product_ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.update(
+                        [table.attribute_summary], [summary],
+                        where=reduce_ids(table.id, sub_ids)))
+        if to_update:
+            clear_record_cache(cls, [p.id for p in products])
+
+    @classmethod
+    def rebuild_attribute_summary(cls, chunk_size=1000):
+        "Store the summary of the attributes of all the products by chunks"
+        last_id = 0
+        with Transaction().set_context(
+                active_test=False, product_attribute_summary=True):
+            while True:
+                products = cls.search([
+                        ('id', '>', last_id),
+                        ], order=[('id', 'ASC')], limit=chunk_size)
+                if not products:
+                    break
+                cls.update_attribute_summary(products)
+                last_id = products[-1].id
+
     def get_product_attribute_set(self, name=None):
         return self.template.attribute_set and self.template.attribute_set.id
 
+    @classmethod
+    def get_attribute_values(cls, products, name=None):
+        """
+        Return attribute name to typed value dictionaries per product id
+
+        The values of the variant are merged over those of its template.
+        """
+        pool = Pool()
+        Template = pool.get('product.template')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        values = {}
+        for sub_products in grouped_slice(
+                products, backend.MAX_QUERY_PARAMS):
+            sub_products = list(sub_products)
+            template_values = Template.get_attribute_values(
+                list({p.template for p in sub_products}))
+            variant_values = defaultdict(dict)
+            for row, attribute, value in ProductAttribute.read_typed_values([
+                        ('product', 'in', [p.id for p in sub_products]),
+                        ]):
+                variant_values[row['product']][attribute] = value
+            for product in sub_products:
+                values[product.id] = {
+                    **template_values[product.template.id],
+                    **variant_values[product.id],
+                    }
+        return values
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Template = pool.get('product.template')
+        products = super().create(vlist)
+        Template.set_attributes_stale({p.template.id for p in products})
+        cls.update_attribute_summary(products)
+        return products
+
     @classmethod
     @ModelView.button
     def update_attributes_values(cls, products):
@@ -314,12 +1304,53 @@ class Product(metaclass=PoolMeta):
 
     @property
     def product_attribute_used(self):
-        # Skip rules to test pattern on all records
-        with Transaction().set_user(0):
-            product = self.__class__(self)
-        for attributes in product.attributes:
-            yield attributes
-        yield from self.template.product_attribute_used()
+        for _, attribute in self.product_attributes_used([self]):
+            yield attribute
+
+    @classmethod
+    def product_attributes_used(cls, products):
+        """
+        Yield the product and attribute pairs of the products
+
+        The attributes of the variant come before those of its template.
+        """
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = ProductAttribute.__table__()
+        product = cls.__table__()
+
+        for sub_products in grouped_slice(
+                products, record_cache_size(transaction)):
+            sub_products = list(sub_products)
+            product_ids = {p.id for p in sub_products}
+            variant = table.select(
+                table.product.as_('record'), Literal(0).as_('level'),
+                table.id.as_('id'),
+                where=reduce_ids(table.product, product_ids))
+            template = table.join(product,
+                condition=table.template == product.template
+                ).select(
+                    product.id.as_('record'), Literal(1).as_('level'),
+                    table.id.as_('id'),
+                    where=reduce_ids(product.id, product_ids)
+                    & (table.product == Null))
+            query = Union(variant, template, all_=True)
+            cursor.execute(*query.select(
+                    query.record, query.id,
+                    order_by=[query.level, query.id]))
+            product2ids = defaultdict(list)
+            for product_id, attribute_id in cursor:
+                product2ids[product_id].append(attribute_id)
+            # Skip rules to test pattern on all records
+            with transaction.set_user(0):
+                attributes = ProductAttribute.browse(
+                    [i for ids in product2ids.values() for i in ids])
+            id2attribute = {a.id: a for a in attributes}
+            for product_ in sub_products:
+                for attribute_id in product2ids[product_.id]:
+                    yield product_, id2attribute[attribute_id]
 
     @classmethod
     def copy(cls, products, default=None):
@@ -333,55 +1364,31 @@ class Product(metaclass=PoolMeta):
         copy_attributes = 'attributes' not in default
         if 'template' in default:
             default.setdefault('attributes', None)
-        new_products = super().copy(products, default)
-        if 'template' in default and copy_attributes:
-            template2new = {}
-            product2new = {}
-            to_copy = []
-            for product, new_product in zip(products, new_products):
-                if product.attributes:
-                    to_copy.extend(product.attributes)
-                    template2new[product.template.id] = new_product.template.id
-                    product2new[product.id] = new_product.id
-            if to_copy:
-                ProductAttribute.copy(to_copy, {
-                        'product': lambda d: product2new[d['product']],
-                        'template': lambda d: template2new[d['template']],
-                        })
+        with instrumentation.measure('copy'):
+            new_products = super().copy(products, default)
+            if 'template' in default and copy_attributes:
+                template2new = {}
+                product2new = {}
+                to_copy = []
+                for product, new_product in zip(products, new_products):
+                    if product.attributes:
+                        to_copy.extend(product.attributes)
+                        template2new[product.template.id] = (
+                            new_product.template.id)
+                        product2new[product.id] = new_product.id
+                if to_copy:
+                    ProductAttribute.copy_attributes(
+                        to_copy, template2new, product2new)
         return new_products
 
 
-class ProductProductAttribute(ModelSQL, ModelView):
-    "Product's Product Attribute"
-    __name__ = 'product.product.attribute'
+class AttributeValueMixin:
+    "Value of an attribute stored in the field of its type"
+    __slots__ = ()
 
-    template = fields.Many2One(
-        "product.template", "Template", required=True,
-        ondelete='CASCADE',
-        domain=[
-            If(Bool(Eval('product')),
-                ('products', '=', Eval('product')),
-                ()),
-            ])
-    product = fields.Many2One(
-        "product.product", "Variant",
-        domain=[
-            If(Bool(Eval('template')),
-                ('template', '=', Eval('template')),
-                ()),
-            ])
-    attribute = fields.Many2One(
-        "product.attribute", "Attribute", required=True,
-        domain=[('sets', '=', Eval('attribute_set'))],
-        ondelete='RESTRICT')
     attribute_type = fields.Function(
         fields.Selection(ATTRIBUTE_TYPES, "Attribute Type"),
         'on_change_with_attribute_type')
-    attribute_set = fields.Function(
-        fields.Many2One("product.attribute.set", "Attribute Set"),
-        'on_change_with_attribute_set', searcher='search_attribute_set')
-    value = fields.Function(fields.Char('Attribute Value'),
-        getter='on_change_with_value')
     value_char = fields.Char(
         "Value Char", translate=True, states={
             'required': Eval('attribute_type') == 'char',
@@ -425,16 +1432,12 @@ class ProductProductAttribute(ModelSQL, ModelView):
             'invisible': ~(Eval('attribute_type') == 'datetime'),
         })
 
-    @fields.depends('product', '_parent_product.template', 'attribute_set')
-    def on_change_product(self):
-        if self.product:
-            self.template = self.product.template
-            self.attribute_set = self.template.attribute_set
-
     @fields.depends('attribute')
     def on_change_with_attribute_type(self, name=None):
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
         if self.attribute:
-            return self.attribute.type_
+            return Attribute.get_type(self.attribute.id)
 
     @fields.depends('attribute_type', 'value_selection', 'value_datetime',
         'value_date', 'value_char', 'value_numeric', 'value_float',
@@ -457,6 +1460,126 @@ class ProductProductAttribute(ModelSQL, ModelView):
             value = getattr(self, 'value_' + self.attribute_type)
             return '%s' % value if value is not None else ''
 
+
+class ProductProductAttribute(AttributeValueMixin, ModelSQL, ModelView):
+    "Product's Product Attribute"
+    __name__ = 'product.product.attribute'
+
+    template = fields.Many2One(
+        "product.template", "Template", required=True,
+        ondelete='CASCADE',
+        domain=[
+            If(Bool(Eval('product')),
+                ('products', '=', Eval('product')),
+                ()),
+            ])
+    product = fields.Many2One(
+        "product.product", "Variant",
+        domain=[
+            If(Bool(Eval('template')),
+                ('template', '=', Eval('template')),
+                ()),
+            ])
+    attribute = fields.Many2One(
+        "product.attribute", "Attribute", required=True,
+        domain=[('sets', '=', Eval('attribute_set'))],
+        ondelete='RESTRICT')
+    attribute_set = fields.Function(
+        fields.Many2One("product.attribute.set", "Attribute Set"),
+        'get_attribute_set', searcher='search_attribute_set')
+    template_attribute_set = fields.Many2One(
+        "product.attribute.set", "Template Attribute Set", readonly=True)
+    value = fields.Function(fields.Char('Attribute Value'), 'get_value',
+        searcher='search_value')
+    value_search = fields.Char("Value Search", readonly=True)
+    value_sort = fields.Float("Value Sort", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.template, Index.Equality()),
+                    (t.attribute, Index.Equality()),
+                    where=t.product == Null),
+                Index(t,
+                    (t.value_selection, Index.Equality()),
+                    where=t.value_selection != Null),
+                Index(t,
+                    (t.template_attribute_set, Index.Equality()),
+                    (t.attribute, Index.Equality())),
+                Index(t, (t.value_search, Index.Equality())),
+                Index(t, (t.value_search, Index.Similarity())),
+                Index(t,
+                    (t.attribute, Index.Equality()),
+                    (t.value_sort, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Template = pool.get('product.template')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        template = Template.__table__()
+
+        exist = backend.TableHandler.table_exist(cls._table)
+        table_h = cls.__table_handler__(module_name)
+        fill_attribute_set = (
+            exist and not table_h.column_exist('template_attribute_set'))
+
+        super().__register__(module_name)
+
+        # Migration from 8.0: store attribute set of template
+        if fill_attribute_set:
+            cursor.execute(*table.update(
+                    [table.template_attribute_set],
+                    [template.select(template.attribute_set,
+                            where=template.id == table.template)]))
+
+    @fields.depends('product', '_parent_product.template', 'attribute_set')
+    def on_change_product(self):
+        if self.product:
+            self.template = self.product.template
+            self.attribute_set = self.template.attribute_set
+
+    @classmethod
+    def get_value(cls, attributes, name):
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        SelectionOption = pool.get('product.attribute.selection_option')
+
+        with instrumentation.measure('value'):
+            instrumentation.add(rows=len(attributes))
+            lang = Lang.get()
+            format_datetime = None
+            if any(a.attribute_type == 'datetime' and a.value_datetime
+                    for a in attributes):
+                format_datetime = DatetimeFormatter.get()
+
+            values = {}
+            for attribute in attributes:
+                type_ = attribute.attribute_type
+                if not type_:
+                    value = None
+                elif type_ == 'selection':
+                    value = (attribute.value_selection
+                        and SelectionOption.get_names(
+                            attribute.attribute.id).get(
+                            attribute.value_selection.id))
+                elif type_ == 'datetime':
+                    value = (attribute.value_datetime
+                        and format_datetime(attribute.value_datetime))
+                elif type_ == 'date':
+                    value = (lang.strftime(attribute.value_date)
+                        if attribute.value_date else None)
+                else:
+                    value = getattr(attribute, 'value_' + type_)
+                    value = '%s' % value if value is not None else ''
+                values[attribute.id] = value
+            return values
+
     @fields.depends('template', '_parent_template.id',
         '_parent_template.attribute_set')
     def on_change_with_attribute_set(self, name=None):
@@ -467,8 +1590,871 @@ class ProductProductAttribute(ModelSQL, ModelView):
             return self.template.attribute_set.id
 
 
+    def get_attribute_set(self, name):
+        return (self.template_attribute_set.id
+            if self.template_attribute_set else None)
+
     @classmethod
     def search_attribute_set(cls, name, clause):
+        _, *nested = clause[0].split('.', 1)
         return [
-            (('template.attribute_set',) + tuple(clause[1:])),
+            ('.'.join(['template_attribute_set'] + nested),)
+            + tuple(clause[1:]),
+            ]
+
+    @classmethod
+    def _template_attribute_sets(cls, template_ids):
+        pool = Pool()
+        Template = pool.get('product.template')
+        return {t.id: t.attribute_set.id if t.attribute_set else None
+            for t in Template.browse(list(template_ids))}
+
+    @classmethod
+    def search_value(cls, name, clause):
+        _, operator, operand = clause[:3]
+        if operator in {'<', '>', '<=', '>='}:
+            return [
+                ('attribute.type_', 'in', value_sort_types(operand)),
+                ('value_sort', operator, value_sort_key(operand)),
+                ]
+        elif operator in {'=', '!='}:
+            operator = {'=': 'in', '!=': 'not in'}[operator]
+            operand = [operand]
+        elif operator not in {'in', 'not in'}:
+            return cls._search_value_text(operator, operand)
+        types_keys = defaultdict(list)
+        for value in operand:
+            key = value_sort_key(value)
+            if key is not None:
+                types_keys[tuple(value_sort_types(value))].append(key)
+        operand = [str(o) if o is not None else o for o in operand]
+        domain = cls._search_value_text(operator, operand)
+        for types, keys in types_keys.items():
+            if operator == 'in':
+                domain = ['OR', domain, [
+                        ('attribute.type_', 'in', list(types)),
+                        ('value_sort', 'in', keys),
+                        ]]
+            else:
+                domain = [domain, ['OR',
+                        ('attribute.type_', 'not in', list(types)),
+                        ('value_sort', '=', None),
+                        ('value_sort', 'not in', keys),
+                        ]]
+        return domain
+
+    @classmethod
+    def _search_value_text(cls, operator, operand):
+        """
+        Return the domain comparing the text of the value
+
+        The stored search value is in the default language, so char and
+        selection values are compared on their translation in other
+        languages.
+        """
+        pool = Pool()
+        Configuration = pool.get('ir.configuration')
+        if Transaction().language == Configuration.get_language():
+            return [('value_search', operator, operand)]
+        return ['OR', [
+                ('attribute.type_', 'not in', ['char', 'selection']),
+                ('value_search', operator, operand),
+                ], [
+                ('attribute.type_', '=', 'char'),
+                ('value_char', operator, operand),
+                ], [
+                ('attribute.type_', '=', 'selection'),
+                ('value_selection.name', operator, operand),
+                ]]
+
+    def get_value_search(self):
+        "Return the normalized text and the sort key of the value"
+        type_ = self.attribute_type
+        value = getattr(self, 'value_' + type_) if type_ else None
+        if type_ == 'selection' and value:
+            value = value.name
+        return value_search_key(type_, value)
+
+    @classmethod
+    def _set_value_search(cls, vlist):
+        "Set the normalized value into the values to create"
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        Configuration = pool.get('ir.configuration')
+        Option = pool.get('product.attribute.selection_option')
+
+        types = {}
+        for values in vlist:
+            if values.get('attribute'):
+                types[id(values)] = Attribute.get_type(values['attribute'])
+        option_ids = {v.get('value_selection') for v in vlist
+            if types.get(id(v)) == 'selection'} - {None}
+        with Transaction().set_context(language=Configuration.get_language()):
+            option_names = {o.id: o.name for o in Option.browse(option_ids)}
+        for values in vlist:
+            type_ = types.get(id(values))
+            value = None
+            if type_:
+                name = 'value_' + type_
+                value = cls._fields[name].sql_format(values.get(name))
+            if type_ == 'selection':
+                value = option_names.get(value)
+            values['value_search'], values['value_sort'] = (
+                value_search_key(type_, value))
+
+    @classmethod
+    def sync_value_search(cls, attributes):
+        "Store the normalized value of the attributes"
+        pool = Pool()
+        Configuration = pool.get('ir.configuration')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        with Transaction().set_context(language=Configuration.get_language()):
+            attributes = cls.browse(attributes)
+        to_update = defaultdict(list)
+        for attribute in attributes:
+            key = attribute.get_value_search()
+            if key != (attribute.value_search, attribute.value_sort):
+                to_update[key].append(attribute.id)
+        for (value_search, value_sort), ids in to_update.items():
+            for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.update(
+                        [table.value_search, table.value_sort],
+                        [value_search, value_sort],
+                        where=reduce_ids(table.id, sub_ids)))
+        if to_update:
+            clear_record_cache(cls, [a.id for a in attributes])
+
+    @classmethod
+    def backfill_value_search(cls, batch_size=1000):
+        "Fill the stored search value of existing attributes in batches"
+        last_id = 0
+        while True:
+            attributes = cls.search([
+                    ('id', '>', last_id),
+                    ], order=[('id', 'ASC')], limit=batch_size)
+            if not attributes:
+                break
+            cls.sync_value_search(attributes)
+            last_id = attributes[-1].id
+
+    @classmethod
+    def create(cls, vlist):
+        attribute_sets = cls._template_attribute_sets(
+            {v['template'] for v in vlist if v.get('template')})
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            values['template_attribute_set'] = attribute_sets.get(
+                values.get('template'))
+        cls._set_value_search(vlist)
+        attributes = super().create(vlist)
+        cls.set_templates_stale(attributes)
+        cls.update_attribute_summary(attributes)
+        return attributes
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        attribute_sets = cls._template_attribute_sets(
+            {v['template'] for _, v in zip(actions, actions)
+                if v.get('template')})
+        args = list(args)
+        moved = []
+        for i in range(1, len(args), 2):
+            values = args[i]
+            if 'template' in values:
+                args[i] = values = values.copy()
+                values['template_attribute_set'] = attribute_sets.get(
+                    values['template'])
+                moved.extend(args[i - 1])
+        # The templates the attributes are moved from are stale too
+        cls.set_templates_stale(moved)
+        # And the products the attributes are moved from
+        actions = iter(args)
+        moved_products = cls._summary_products([
+                a for attributes, values in zip(actions, actions)
+                if {'template', 'product'} & values.keys()
+                for a in attributes])
+        super().write(*args)
+        to_sync, to_stale = [], []
+        actions = iter(args)
+        for attributes, values in zip(actions, actions):
+            if VALUE_FIELDS & values.keys():
+                to_sync.extend(attributes)
+            if (VALUE_FIELDS | {'template', 'product', 'attribute'}
+                    ) & values.keys():
+                to_stale.extend(attributes)
+        if to_sync:
+            cls.sync_value_search(to_sync)
+        cls.set_templates_stale(to_stale)
+        cls.update_attribute_summary(to_stale, moved_products)
+
+    @classmethod
+    def delete(cls, attributes):
+        pool = Pool()
+        Product = pool.get('product.product')
+        cls.set_templates_stale(attributes)
+        products = cls._summary_products(attributes)
+        super().delete(attributes)
+        Product.update_attribute_summary(products)
+
+    @classmethod
+    def _validate(cls, attributes, field_names=None):
+        # The domains of template, product, attribute and value_selection are
+        # checked in bulk by check_strict instead of record by record
+        if field_names is None:
+            field_names = cls._fields.keys()
+        for name in ['template', 'attribute']:
+            if name not in field_names:
+                continue
+            for attribute in attributes:
+                if not getattr(attribute, name):
+                    raise RequiredValidationError(
+                        gettext('ir.msg_required_validation_record',
+                            **cls.__names__(name, attribute)))
+        super()._validate(attributes, set(field_names) - {
+                'template', 'product', 'attribute', 'value_selection'})
+
+    @classmethod
+    def validate(cls, attributes):
+        super().validate(attributes)
+        cls.check_strict(attributes)
+
+    @classmethod
+    def check_strict(cls, attributes):
+        "Check the consistency of the attributes in bulk"
+        for sub_ids in grouped_slice(
+                [a.id for a in attributes], backend.MAX_QUERY_PARAMS):
+            for attribute_id, check in cls.strict_violations(sub_ids):
+                attribute = cls(attribute_id)
+                raise ValidationError(gettext(
+                        'product_attribute_strict.msg_strict_%s' % check,
+                        attribute=attribute.attribute.rec_name,
+                        template=attribute.template.rec_name))
+
+    @classmethod
+    def strict_violations(cls, ids):
+        """
+        Return the id and the name of the failed check of the attributes
+        which are inconsistent
+
+        The checks are:
+            - attribute_set: the attribute is not in the set of the template
+            - template: the variant is not of the template
+            - value: the value of the attribute type is missing
+            - selection: the option is not of the attribute
+        """
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Attribute = pool.get('product.attribute')
+        AttributeSet = pool.get('product.attribute-product.attribute-set')
+        Option = pool.get('product.attribute.selection_option')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        template = Template.__table__()
+        product = Product.__table__()
+        attribute = Attribute.__table__()
+        attribute_set = AttributeSet.__table__()
+        option = Option.__table__()
+
+        where = reduce_ids(table.id, ids)
+        missing_value = Literal(False)
+        for type_, _ in ATTRIBUTE_TYPES:
+            if type_ == 'boolean':
+                continue
+            column = Column(table, 'value_%s' % type_)
+            missing = column == Null
+            if type_ == 'char':
+                missing |= column == ''
+            missing_value |= (attribute.type_ == type_) & missing
+        queries = [
+            ('attribute_set', table.join(template,
+                    condition=template.id == table.template
+                    ).join(attribute_set, 'LEFT',
+                    condition=(attribute_set.attribute_set
+                        == template.attribute_set)
+                    & (attribute_set.attribute == table.attribute)
+                    ).select(table.id,
+                    where=where & (attribute_set.id == Null))),
+            ('template', table.join(product,
+                    condition=product.id == table.product
+                    ).select(table.id,
+                    where=where & (product.template != table.template))),
+            ('value', table.join(attribute,
+                    condition=attribute.id == table.attribute
+                    ).select(table.id, where=where & missing_value)),
+            ('selection', table.join(option,
+                    condition=option.id == table.value_selection
+                    ).select(table.id,
+                    where=where & (option.attribute != table.attribute))),
             ]
+        violations = []
+        for check, query in queries:
+            cursor.execute(*query)
+            violations.extend((i, check) for i, in cursor)
+        return violations
+
+    @classmethod
+    def audit_strict(cls, chunk_size=1000):
+        """
+        Check the consistency of all the attributes by chunks
+
+        The violations are logged and returned.
+        """
+        violations = []
+        last_id = 0
+        while True:
+            ids = [a.id for a in cls.search([
+                        ('id', '>', last_id),
+                        ], order=[('id', 'ASC')], limit=chunk_size)]
+            if not ids:
+                break
+            chunk_violations = cls.strict_violations(ids)
+            for attribute_id, check in chunk_violations:
+                logger.warning(
+                    "product attribute %s fails %s check", attribute_id, check)
+            violations.extend(chunk_violations)
+            last_id = ids[-1]
+        return violations
+
+    @classmethod
+    def set_templates_stale(cls, attributes):
+        "Flag the templates of the attributes as stale"
+        pool = Pool()
+        Template = pool.get('product.template')
+        Template.set_attributes_stale(
+            {a.template.id for a in attributes if a.template})
+
+    @classmethod
+    def _summary_products(cls, attributes):
+        "Return the ids of the products summarizing the attributes"
+        pool = Pool()
+        Product = pool.get('product.product')
+        if not attributes or not Product.attribute_summary_enabled():
+            return []
+        attributes = cls.browse(attributes)
+        product_ids = {a.product.id for a in attributes if a.product}
+        template_ids = {
+            a.template.id for a in attributes if a.template and not a.product}
+        if template_ids:
+            with Transaction().set_context(active_test=False):
+                product_ids.update(p.id for p in Product.search([
+                            ('template', 'in', list(template_ids)),
+                            ]))
+        return list(product_ids)
+
+    @classmethod
+    def update_attribute_summary(cls, attributes, products=None):
+        "Update the summary of the products of the attributes"
+        pool = Pool()
+        Product = pool.get('product.product')
+        product_ids = set(cls._summary_products(attributes))
+        product_ids.update(products or [])
+        Product.update_attribute_summary(list(product_ids))
+
+    @classmethod
+    def copy_attributes(cls, attributes, templates, products=None):
+        """
+        Duplicate the attributes and their translations in bulk
+
+        templates and products map the old ids to the new ones. The rows are
+        copied with SQL by chunks without going through the ORM, then the
+        copies are checked in bulk like created attributes.
+        Return the mapping of the old attribute ids to the new ones.
+        """
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        Translation = pool.get('ir.translation')
+        Template = pool.get('product.template')
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        translation = Translation.__table__()
+        products = products or {}
+        ModelAccess.check(cls.__name__, 'create')
+
+        names = [n for n, f in cls._fields.items()
+            if not hasattr(f, 'get') and n not in {
+                    'id', 'create_uid', 'create_date', 'write_uid',
+                    'write_date'}]
+        columns = [Column(table, n) for n in names] + [
+            table.create_uid, table.create_date]
+        translated = ['%s,%s' % (cls.__name__, n) for n in names
+            if getattr(cls._fields[n], 'translate', False)]
+        translation_columns = [
+            translation.name, translation.lang, translation.type,
+            translation.src, translation.value, translation.module,
+            translation.fuzzy, translation.res_id,
+            translation.create_uid, translation.create_date]
+        attribute_sets = cls._template_attribute_sets(set(templates.values()))
+
+        def insert(table, columns, values):
+            ids = None
+            if len(values) > 1:
+                ids = database.nextid(
+                    transaction.connection, table._name, count=len(values))
+            if ids is not None:
+                cursor.execute(*table.insert(
+                        columns + [table.id],
+                        [v + [i] for v, i in zip(values, ids)]))
+                return ids
+            ids = []
+            for value in values:
+                if database.has_returning():
+                    cursor.execute(*table.insert(columns, [value], [table.id]))
+                    ids.append(cursor.fetchone()[0])
+                else:
+                    cursor.execute(*table.insert(columns, [value]))
+                    ids.append(database.lastid(cursor))
+            return ids
+
+        old2new = {}
+        for sub_ids in grouped_slice(
+                [a.id for a in attributes],
+                backend.MAX_QUERY_PARAMS // (len(columns) + 1)):
+            cursor.execute(*table.select(
+                    table.id, *columns[:len(names)],
+                    where=reduce_ids(table.id, sub_ids)))
+            old_ids, values = [], []
+            for id_, *row in cursor.fetchall():
+                row = dict(zip(names, row))
+                row['template'] = templates[row['template']]
+                if row['product']:
+                    row['product'] = products.get(
+                        row['product'], row['product'])
+                row['template_attribute_set'] = attribute_sets.get(
+                    row['template'])
+                old_ids.append(id_)
+                values.append([row[n] for n in names] + [
+                        transaction.user, CurrentTimestamp()])
+            old2new.update(zip(old_ids, insert(table, columns, values)))
+            instrumentation.add(rows=len(old_ids))
+
+            if not translated:
+                continue
+            cursor.execute(*translation.select(
+                    *translation_columns[:-3], translation.res_id,
+                    where=translation.name.in_(translated)
+                    & (translation.type == 'model')
+                    & reduce_ids(translation.res_id, old_ids)))
+            values = [list(row[:-1]) + [
+                    old2new[row[-1]], transaction.user, CurrentTimestamp()]
+                for row in cursor.fetchall()]
+            if values:
+                insert(translation, translation_columns, values)
+        cls.check_strict(cls.browse(list(old2new.values())))
+        Template.set_attributes_stale(set(templates.values()))
+        cls.update_attribute_summary(cls.browse(old2new.values()))
+        return old2new
+
+    @classmethod
+    def import_csv(cls, file, chunk_size=1000, header=True, **fmtparams):
+        """
+        Import attribute values of variants from a CSV file
+
+        Each row contains the variant code, the attribute name and the value.
+        The rows are processed by chunks of chunk_size, existing values are
+        updated and missing ones are created. Empty rows are skipped.
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+
+        attributes = {a['name']: (a['id'], a['type_'])
+            for a in Attribute.search_read([], fields_names=['name', 'type_'])}
+
+        reader = csv.reader(file, **fmtparams)
+        start = 1
+        if header:
+            next(reader, None)
+            start += 1
+        lines = ((line, row) for line, row in enumerate(reader, start) if row)
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                break
+            cls._import_rows(chunk, attributes)
+
+    @classmethod
+    def _import_rows(cls, rows, attributes):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Option = pool.get('product.attribute.selection_option')
+
+        products = {p['code']: (p['id'], p['template'])
+            for p in Product.search_read([
+                    ('code', 'in', list({r[0] for _, r in rows})),
+                    ], fields_names=['code', 'template'])}
+
+        to_save = {}
+        for line, row in rows:
+            if len(row) != 3:
+                raise UserError(gettext(
+                        'product_attribute_strict.msg_import_invalid_row',
+                        line=line, columns=len(row)))
+            code, name, text = row
+            if code not in products:
+                raise UserError(gettext(
+                        'product_attribute_strict.msg_import_unknown_product',
+                        line=line, code=code))
+            if name not in attributes:
+                raise UserError(gettext(
+                        'product_attribute_strict'
+                        '.msg_import_unknown_attribute',
+                        line=line, attribute=name))
+            attribute_id, type_ = attributes[name]
+            if type_ == 'selection':
+                options = Option.get_ids(attribute_id)
+                if text not in options:
+                    raise UserError(gettext(
+                            'product_attribute_strict'
+                            '.msg_import_unknown_option',
+                            line=line, attribute=name, value=text))
+                value = options[text]
+            else:
+                try:
+                    value = VALUE_PARSERS[type_](text)
+                except (ValueError, InvalidOperation):
+                    raise UserError(gettext(
+                            'product_attribute_strict'
+                            '.msg_import_invalid_value',
+                            line=line, attribute=name, value=text,
+                            type=type_))
+            product_id, template_id = products[code]
+            to_save[(product_id, attribute_id)] = {
+                'template': template_id,
+                'product': product_id,
+                'attribute': attribute_id,
+                'value_' + type_: value,
+                }
+
+        existing = cls.search([
+                ('product', 'in', list({p for p, _ in to_save})),
+                ('attribute', 'in', list({a for _, a in to_save})),
+                ])
+        to_write = []
+        for record in existing:
+            values = to_save.pop(
+                (record.product.id, record.attribute.id), None)
+            if values:
+                to_write.extend(([record], {
+                            k: v for k, v in values.items()
+                            if k.startswith('value_')}))
+        if to_write:
+            cls.write(*to_write)
+        if to_save:
+            cls.create(list(to_save.values()))
+
+    @classmethod
+    def facet_counts(cls, domain, attributes, buckets=None):
+        """
+        Return the number of variants matching the product domain per value
+        of the attributes
+
+        The values of the variant replace those of its template. The values
+        of selection attributes are the option ids. buckets maps the ids of
+        numeric attributes to the size of the intervals into which their
+        values are grouped and counted by lower bound.
+        Returns a dictionary of value counts per attribute id.
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        Product = pool.get('product.product')
+        cursor = Transaction().connection.cursor()
+
+        buckets = buckets or {}
+        types = {a.id: a.type_ for a in Attribute.browse(attributes)}
+        if not types:
+            return {}
+        products = Product.search(domain, query=True)
+
+        def rows(product, table, condition, where):
+            "Select the attribute values of the products"
+            columns = []
+            for type_, _ in ATTRIBUTE_TYPES:
+                column = Column(table, 'value_%s' % type_)
+                if buckets and type_ in {'integer', 'float', 'numeric'}:
+                    column = Case(
+                        (table.attribute.in_(list(buckets)), Null),
+                        else_=column)
+                columns.append(column.as_('value_%s' % type_))
+            if buckets:
+                columns.append(Case(*((
+                                (table.attribute == attribute_id)
+                                & (table.value_sort != Null),
+                                Floor(table.value_sort / size) * size)
+                            for attribute_id, size in buckets.items()),
+                        else_=Null).as_('bucket'))
+            return product.join(table, condition=condition).select(
+                product.id.as_('product'), table.attribute, *columns,
+                where=product.id.in_(products)
+                & reduce_ids(table.attribute, list(types))
+                & where)
+
+        product, table = Product.__table__(), cls.__table__()
+        variant_rows = rows(
+            product, table, table.product == product.id, Literal(True))
+        # The template values are used only when the variant has none
+        product, table, variant = (
+            Product.__table__(), cls.__table__(), cls.__table__())
+        template_rows = rows(product, table,
+            (table.template == product.template) & (table.product == Null),
+            ~Exists(variant.select(variant.id,
+                    where=(variant.product == product.id)
+                    & (variant.attribute == table.attribute))))
+        query = Union(variant_rows, template_rows, all_=True)
+
+        value_columns = [Column(query, 'value_%s' % type_)
+            for type_, _ in ATTRIBUTE_TYPES]
+        if buckets:
+            value_columns.append(query.bucket)
+        cursor.execute(*query.select(
+                query.attribute, Count(query.product, distinct=True),
+                *value_columns,
+                group_by=[query.attribute] + value_columns))
+
+        counts = {attribute_id: defaultdict(int) for attribute_id in types}
+        type_indexes = {
+            type_: i for i, (type_, _) in enumerate(ATTRIBUTE_TYPES)}
+        for attribute_id, count, *values in cursor:
+            if attribute_id in buckets:
+                value = values[-1]
+            else:
+                value = values[type_indexes[types[attribute_id]]]
+                if value is not None and types[attribute_id] == 'boolean':
+                    value = bool(value)
+            counts[attribute_id][value] += count
+        return {a: dict(c) for a, c in counts.items()}
+
+    @classmethod
+    def read_typed_values(cls, domain):
+        """
+        Yield the row, the attribute name and the typed value of the
+        attributes matching the domain
+
+        The row contains the template and the product ids.
+        The value of selection attributes is the option name.
+        """
+        fields_names = ['template', 'product', 'attribute.name',
+            'attribute.type_', 'value_selection.name']
+        fields_names.extend('value_%s' % type_
+            for type_, _ in ATTRIBUTE_TYPES if type_ != 'selection')
+        for row in cls.search_read(
+                domain, order=[('id', 'ASC')], fields_names=fields_names):
+            type_ = row['attribute.']['type_']
+            if type_ == 'selection':
+                option = row['value_selection.']
+                value = option['name'] if option else None
+            else:
+                value = row['value_%s' % type_]
+            yield row, row['attribute.']['name'], value
+
+    @classmethod
+    def export_rows(cls, domain=None, chunk_size=1000):
+        """
+        Yield the variant code, the attribute name and the value of the
+        variant attributes matching the domain
+
+        The values are formatted in the language of the context as expected
+        by import_csv.
+        """
+        fields_names = ['product.code', 'attribute.name', 'attribute.type_',
+            'value_selection.name']
+        fields_names.extend('value_%s' % type_
+            for type_, _ in ATTRIBUTE_TYPES if type_ != 'selection')
+        domain = domain or []
+        last_id = 0
+        while True:
+            attributes = cls.search_read([
+                    ('id', '>', last_id),
+                    ('product', '!=', None),
+                    domain,
+                    ], order=[('id', 'ASC')], limit=chunk_size,
+                fields_names=fields_names)
+            if not attributes:
+                break
+            for attribute in attributes:
+                type_ = attribute['attribute.']['type_']
+                if type_ == 'selection':
+                    option = attribute['value_selection.']
+                    value = option['name'] if option else None
+                else:
+                    value = attribute['value_%s' % type_]
+                    if type_ == 'boolean':
+                        value = bool(value)
+                    if value is not None:
+                        value = str(value)
+                yield (attribute['product.']['code'],
+                    attribute['attribute.']['name'], value)
+            last_id = attributes[-1]['id']
+
+    @classmethod
+    def export_csv(cls, file, domain=None, chunk_size=1000, header=True,
+            **fmtparams):
+        "Write the attributes matching the domain as CSV into the file"
+        writer = csv.writer(file, **fmtparams)
+        if header:
+            writer.writerow(['code', 'attribute', 'value'])
+        writer.writerows(cls.export_rows(domain, chunk_size=chunk_size))
+
+    @classmethod
+    def export_snapshot(cls, file, domain=None, chunk_size=10000):
+        """
+        Write the attributes matching the domain as a columnar snapshot into
+        the binary file
+
+        The rows are read by chunks so the memory used does not depend on the
+        number of attributes. The snapshot is read with snapshot.read.
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        SelectionOption = pool.get('product.attribute.selection_option')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        attribute = Attribute.__table__()
+
+        types = [t for t, _ in ATTRIBUTE_TYPES]
+        writer = snapshot.SnapshotWriter(file)
+        attribute_ids, option_ids = set(), set()
+        domain = domain or []
+        last_id = 0
+        while True:
+            ids = [a.id for a in cls.search([
+                        ('id', '>', last_id),
+                        domain,
+                        ], order=[('id', 'ASC')], limit=chunk_size)]
+            if not ids:
+                break
+            columns = [table.id, table.template, table.product,
+                table.attribute, attribute.type_]
+            columns.extend(Column(table, 'value_%s' % type_)
+                for type_, _ in ATTRIBUTE_TYPES)
+            cursor.execute(*table.join(attribute,
+                    condition=attribute.id == table.attribute
+                    ).select(*columns,
+                    where=reduce_ids(table.id, ids),
+                    order_by=table.id))
+            rows = cursor.fetchall()
+
+            new_attribute_ids = {r[3] for r in rows} - attribute_ids
+            writer.add_attributes(
+                (a['id'], a['name'], a['type_'])
+                for a in Attribute.read(
+                    list(new_attribute_ids), ['name', 'type_']))
+            attribute_ids |= new_attribute_ids
+            new_option_ids = {r[-1] for r in rows if r[-1]} - option_ids
+            writer.add_options(
+                (o['id'], o['name'])
+                for o in SelectionOption.read(list(new_option_ids), ['name']))
+            option_ids |= new_option_ids
+
+            for id_, template, product, attribute_id, type_, *values in rows:
+                value = values[types.index(type_)]
+                if type_ == 'boolean':
+                    value = bool(value)
+                elif type_ == 'numeric' and value is not None:
+                    value = Decimal(str(value))
+                writer.append(id_, template, product, attribute_id, value)
+            writer.flush()
+            last_id = ids[-1]
+
+
+class ApplyAttributeSetStart(ModelView):
+    "Apply Attribute Set"
+    __name__ = 'product.attribute.set.apply.start'
+
+    attribute_set = fields.Many2One(
+        'product.attribute.set', "Attribute Set", required=True)
+    values = fields.One2Many(
+        'product.attribute.set.apply.value', None, "Values",
+        help="The values of the attributes created on the templates.")
+
+    @fields.depends('attribute_set')
+    def on_change_attribute_set(self):
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        Value = pool.get('product.attribute.set.apply.value')
+
+        values = []
+        if self.attribute_set:
+            for attribute_id, type_ in AttributeSet.get_attributes_types(
+                    self.attribute_set.id):
+                value = Value(attribute=attribute_id, attribute_type=type_)
+                value.value = value.on_change_with_value()
+                values.append(value)
+        self.values = values
+
+
+class ApplyAttributeSetValue(AttributeValueMixin, ModelView):
+    "Apply Attribute Set Value"
+    __name__ = 'product.attribute.set.apply.value'
+
+    attribute = fields.Many2One(
+        'product.attribute', "Attribute", readonly=True)
+    value = fields.Function(fields.Char("Value"), 'on_change_with_value')
+
+    def get_values(self):
+        "Return the values to create the attribute with"
+        if not self.attribute_type:
+            return {}
+        name = 'value_' + self.attribute_type
+        value = getattr(self, name)
+        if isinstance(value, ModelStorage):
+            value = value.id
+        return {name: value}
+
+
+class ApplyAttributeSet(Wizard):
+    "Apply Attribute Set"
+    __name__ = 'product.attribute.set.apply'
+
+    start = StateView('product.attribute.set.apply.start',
+        'product_attribute_strict.attribute_set_apply_start_view_form', [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Apply", 'apply', 'tryton-ok', default=True),
+            ])
+    apply = StateTransition()
+
+    def transition_apply(self):
+        pool = Pool()
+        Template = pool.get('product.template')
+        values = {v.attribute.id: v.get_values() for v in self.start.values}
+        Template.apply_attribute_set(
+            self.records, self.start.attribute_set, values)
+        return 'end'
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+
+    @classmethod
+    def on_modification(cls, mode, companies, field_names=None):
+        super().on_modification(mode, companies, field_names=field_names)
+        if (mode == 'delete'
+                or field_names is None or 'timezone' in field_names):
+            DatetimeFormatter.clear()
+
+
+class Lang(metaclass=PoolMeta):
+    __name__ = 'ir.lang'
+
+    @classmethod
+    def on_modification(cls, mode, languages, field_names=None):
+        super().on_modification(mode, languages, field_names=field_names)
+        DatetimeFormatter.clear()
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('product.template|update_stale_attributes_values',
+                    "Update Stale Attribute Values"),
+                ('product.product.attribute|audit_strict',
+                    "Audit Product Attributes"),
+                ])
@@ -0,0 +1,261 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Columnar snapshot of product attributes
+
+A snapshot is a stream of chunks. Each chunk is a little-endian length, a JSON
+header and the bytes of its columns. The attribute and option names are
+dictionary-encoded: a chunk header contains only the entries that are new
+since the previous chunks and the columns store indexes into the
+dictionaries. The values are stored in one column per type holding only the
+rows of that type, the char and numeric values as UTF-8 data with offsets.
+
+The module depends only on the standard library so snapshots can be read
+without trytond.
+"""
+import datetime as dt
+import json
+import struct
+import sys
+from array import array
+from decimal import Decimal
+
+MAGIC = b'PASNAP\x01\n'
+EPOCH = dt.datetime(1970, 1, 1)
+_LENGTH = struct.Struct('<I')
+
+# Type codes of the columns holding one value per row
+ROW_COLUMNS = {
+    'id': 'q',
+    'template': 'q',
+    'product': 'q',
+    'attribute': 'i',
+    'null': 'b',
+    }
+# Type codes of the value columns holding one value per row of the type
+VALUE_COLUMNS = {
+    'boolean': 'b',
+    'integer': 'q',
+    'float': 'd',
+    'date': 'i',
+    'datetime': 'q',
+    'selection': 'i',
+    }
+TEXT_TYPES = ('char', 'numeric')
+
+
+def _encode(type_, value):
+    if type_ == 'date':
+        return value.toordinal()
+    elif type_ == 'datetime':
+        return (value - EPOCH) // dt.timedelta(microseconds=1)
+    elif type_ == 'numeric':
+        return str(value)
+    return value
+
+
+def _decode(type_, value):
+    if type_ == 'boolean':
+        return bool(value)
+    elif type_ == 'date':
+        return dt.date.fromordinal(value)
+    elif type_ == 'datetime':
+        return EPOCH + dt.timedelta(microseconds=value)
+    elif type_ == 'numeric':
+        return Decimal(value)
+    return value
+
+
+def _null(type_):
+    if type_ in TEXT_TYPES:
+        return ''
+    return 0
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, itemsize, data):
+    values = array(typecode)
+    if values.itemsize != itemsize:
+        raise ValueError(
+            "Column of type %r has items of %s bytes instead of %s"
+            % (typecode, values.itemsize, itemsize))
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class Chunk:
+    """
+    Columns of consecutive attribute rows
+
+    attributes and options are the dictionaries shared by the chunks of the
+    snapshot: lists of (id, name, type) and (id, name).
+    """
+
+    def __init__(self, attributes, options):
+        self.attributes = attributes
+        self.options = options
+        self.columns = {n: array(c) for n, c in ROW_COLUMNS.items()}
+        self.values = {t: array(c) for t, c in VALUE_COLUMNS.items()}
+        self.texts = {t: [] for t in TEXT_TYPES}
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def rows(self):
+        """
+        Yield the id, template id, product id, attribute name and typed value
+        of the rows
+
+        The value of selection attributes is the option name.
+        """
+        positions = dict.fromkeys([*self.values, *self.texts], 0)
+        columns = self.columns
+        for i, attribute in enumerate(columns['attribute']):
+            _, name, type_ = self.attributes[attribute]
+            position = positions[type_]
+            positions[type_] += 1
+            value = None
+            if not columns['null'][i]:
+                if type_ in TEXT_TYPES:
+                    value = self.texts[type_][position]
+                else:
+                    value = self.values[type_][position]
+                if type_ == 'selection':
+                    value = self.options[value][1]
+                else:
+                    value = _decode(type_, value)
+            yield (columns['id'][i], columns['template'][i],
+                columns['product'][i] or None, name, value)
+
+
+class SnapshotWriter:
+    "Write chunks of attribute rows into a binary file"
+
+    def __init__(self, file):
+        self.file = file
+        self.attributes = []
+        self.options = []
+        self._attribute_index = {}
+        self._option_index = {}
+        self._chunk = None
+        # Number of dictionary entries already written
+        self._written = (0, 0)
+        file.write(MAGIC)
+
+    def add_attributes(self, attributes):
+        "Add the (id, name, type) of the attributes to the dictionary"
+        for attribute in attributes:
+            if attribute[0] not in self._attribute_index:
+                self._attribute_index[attribute[0]] = len(self.attributes)
+                self.attributes.append(tuple(attribute))
+
+    def add_options(self, options):
+        "Add the (id, name) of the options to the dictionary"
+        for option in options:
+            if option[0] not in self._option_index:
+                self._option_index[option[0]] = len(self.options)
+                self.options.append(tuple(option))
+
+    def _start(self):
+        if self._chunk is None:
+            self._chunk = Chunk(self.attributes, self.options)
+        return self._chunk
+
+    def append(self, id, template, product, attribute, value):
+        """
+        Append a row to the current chunk
+
+        attribute is the id of an attribute added to the dictionary and value
+        is typed, the option id for selection attributes.
+        """
+        chunk = self._start()
+        index = self._attribute_index[attribute]
+        type_ = self.attributes[index][2]
+        columns = chunk.columns
+        columns['id'].append(id)
+        columns['template'].append(template)
+        columns['product'].append(product or 0)
+        columns['attribute'].append(index)
+        columns['null'].append(value is None)
+        if value is None:
+            value = _null(type_)
+        elif type_ == 'selection':
+            value = self._option_index[value]
+        else:
+            value = _encode(type_, value)
+        if type_ in TEXT_TYPES:
+            chunk.texts[type_].append(value)
+        else:
+            chunk.values[type_].append(value)
+
+    def flush(self):
+        "Write the current chunk"
+        chunk = self._chunk
+        if chunk is None:
+            return
+        columns = []
+        for name, values in chunk.columns.items():
+            columns.append((name, values))
+        for type_, values in chunk.values.items():
+            columns.append(('value_%s' % type_, values))
+        for type_, texts in chunk.texts.items():
+            data = [t.encode('utf-8') for t in texts]
+            offsets = array('q', [0])
+            for value in data:
+                offsets.append(offsets[-1] + len(value))
+            columns.append(('value_%s.offsets' % type_, offsets))
+            columns.append(
+                ('value_%s.data' % type_, array('B', b''.join(data))))
+        attributes, options = self._written
+        header = json.dumps({
+                'rows': len(chunk),
+                'attributes': self.attributes[attributes:],
+                'options': self.options[options:],
+                'columns': [
+                    [n, v.typecode, v.itemsize, len(v) * v.itemsize]
+                    for n, v in columns],
+                }).encode('utf-8')
+        self.file.write(_LENGTH.pack(len(header)))
+        self.file.write(header)
+        for _, values in columns:
+            self.file.write(_to_bytes(values))
+        self._written = (len(self.attributes), len(self.options))
+        self._chunk = None
+
+
+def read(file):
+    "Yield the chunks of the snapshot in the binary file"
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a product attribute snapshot")
+    attributes, options = [], []
+    while True:
+        length = file.read(_LENGTH.size)
+        if not length:
+            break
+        length, = _LENGTH.unpack(length)
+        header = json.loads(file.read(length))
+        attributes.extend(tuple(a) for a in header['attributes'])
+        options.extend(tuple(o) for o in header['options'])
+        chunk = Chunk(attributes, options)
+        columns = {}
+        for name, typecode, itemsize, size in header['columns']:
+            columns[name] = _from_bytes(typecode, itemsize, file.read(size))
+        for name in ROW_COLUMNS:
+            chunk.columns[name] = columns[name]
+        for type_ in VALUE_COLUMNS:
+            chunk.values[type_] = columns['value_%s' % type_]
+        for type_ in TEXT_TYPES:
+            offsets = columns['value_%s.offsets' % type_]
+            data = columns['value_%s.data' % type_].tobytes()
+            chunk.texts[type_] = [
+                data[start:end].decode('utf-8')
+                for start, end in zip(offsets, offsets[1:])]
+        yield chunk
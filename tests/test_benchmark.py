@@ -0,0 +1,291 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import datetime as dt
+import os
+import sys
+import time
+import unittest
+from contextlib import contextmanager
+from decimal import Decimal
+
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.modules.product_attribute_strict.instrument import (
+    instrumentation)
+from trytond.modules.product_attribute_strict.product import ATTRIBUTE_TYPES
+from trytond.modules.product_attribute_strict.tests.test_module import (
+    create_attribute_set, create_template)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, with_transaction
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+BENCHMARK = os.getenv('BENCHMARK')
+SIZES = [int(s) for s in os.getenv('BENCHMARK_SIZES', '100,1000').split(',')]
+# Maximum ratio between the time per row of the largest and smallest sizes
+GROWTH = float(os.getenv('BENCHMARK_GROWTH', 3))
+# Size of the seeded catalog
+TEMPLATES = int(os.getenv('BENCHMARK_TEMPLATES', 50))
+VARIANTS = int(os.getenv('BENCHMARK_VARIANTS', 4))
+ATTRIBUTES = int(os.getenv('BENCHMARK_ATTRIBUTES', 1))
+# Number of attribute rows of the facet counts benchmark
+FACET_ROWS = int(os.getenv('BENCHMARK_FACET_ROWS', 1000000))
+# Maximum queries and seconds per operation for the default catalog size,
+# overridden by BENCHMARK_MAX_QUERIES_<OPERATION> and
+# BENCHMARK_MAX_TIME_<OPERATION>
+THRESHOLDS = {
+    'update_attributes_values': (600, 10),
+    'read_value': (20, 5),
+    'copy': (8000, 30),
+    'search_attribute_set': (5, 1),
+    'on_change_attribute_set': (5, 1),
+    'facet_counts': (10, 30),
+    }
+
+VALUES = {
+    'boolean': lambda i: {'value_boolean': bool(i % 2)},
+    'integer': lambda i: {'value_integer': i},
+    'char': lambda i: {'value_char': 'Char %s' % i},
+    'float': lambda i: {'value_float': i / 3},
+    'numeric': lambda i: {'value_numeric': Decimal(i) / 4},
+    'date': lambda i: {'value_date': dt.date(2020, 1, 1 + i % 28)},
+    'datetime': lambda i: {
+        'value_datetime': dt.datetime(2020, 1, 1, i % 24, i % 60)},
+    }
+
+
+def report(name, size, duration):
+    sys.stderr.write('\n%s[%s]: %.3fs (%.3fms/row)' % (
+            name, size, duration, duration / size * 1000))
+
+
+def seed(templates, variants, attributes):
+    """
+    Create templates with variants and attributes of every type at template
+    and variant level
+    """
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+    ProductAttribute = pool.get('product.product.attribute')
+
+    definitions = [
+        ('%s_%s' % (type_, i), type_, ['Option %s' % j for j in range(10)])
+        for type_, _ in ATTRIBUTE_TYPES for i in range(attributes)]
+    attribute_set, attributes = create_attribute_set(definitions, [
+            ('template,name', ' '.join(
+                    '{{ %s }}' % name for name, _, _ in definitions)),
+            ])
+
+    def values(attribute, i):
+        if attribute.type_ == 'selection':
+            return {'value_selection': attribute.selection[
+                    i % len(attribute.selection)].id}
+        return VALUES[attribute.type_](i)
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    templates = Template.create([{
+                'name': 'Template %s' % i,
+                'default_uom': unit.id,
+                'attribute_set': attribute_set.id,
+                'products': [('create', [{}] * variants)],
+                } for i in range(templates)])
+    ProductAttribute.create([{
+                'template': t.id,
+                'product': p.id if p else None,
+                'attribute': a.id,
+                **values(a, i),
+                }
+            for i, t in enumerate(templates)
+            for p in [None] + list(t.products)
+            for a in attributes])
+    return attribute_set, templates
+
+
+@unittest.skipUnless(BENCHMARK, "BENCHMARK is not set")
+class ProductAttributeStrictBenchmarkTestCase(unittest.TestCase):
+    "Benchmark ProductAttributeStrict module"
+
+    @classmethod
+    def setUpClass(cls):
+        activate_module('product_attribute_strict')
+
+    @contextmanager
+    def assertThreshold(self, name, size):
+        "Report the time and queries of the operation and check thresholds"
+        max_queries, max_time = THRESHOLDS[name]
+        max_queries = int(os.getenv(
+                'BENCHMARK_MAX_QUERIES_%s' % name.upper(), max_queries))
+        max_time = float(os.getenv(
+                'BENCHMARK_MAX_TIME_%s' % name.upper(), max_time))
+        start = time.perf_counter()
+        with instrumentation.count_queries() as queries:
+            yield
+        duration = time.perf_counter() - start
+        report(name, size, duration)
+        sys.stderr.write(' %s queries' % queries.count)
+        self.assertLessEqual(queries.count, max_queries, name)
+        self.assertLessEqual(duration, max_time, name)
+
+    def assertLinear(self, durations):
+        "Assert the time per row does not grow more than GROWTH"
+        (small, small_duration), *_, (large, large_duration) = sorted(
+            durations.items())
+        self.assertLessEqual(
+            (large_duration / large) / (small_duration / small), GROWTH)
+
+    @with_transaction()
+    def test_create_validation(self):
+        "Benchmark validation of attributes on bulk create"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        transaction = Transaction()
+
+        durations = {}
+        for size in SIZES:
+            attribute_set, (brand,) = create_attribute_set([
+                    ('Brand', 'char', []),
+                    ])
+            templates = [create_template(attribute_set, [])
+                for _ in range(size)]
+            start = time.perf_counter()
+            ProductAttribute.create([{
+                        'template': t.id,
+                        'attribute': brand.id,
+                        'value_char': 'ACME',
+                        } for t in templates])
+            durations[size] = time.perf_counter() - start
+            report('create_validation', size, durations[size])
+            transaction.rollback()
+        self.assertLinear(durations)
+
+    @with_transaction()
+    def test_copy_attributes(self):
+        "Benchmark copy of attributes through the ORM and in bulk"
+        pool = Pool()
+        Template = pool.get('product.template')
+        ProductAttribute = pool.get('product.product.attribute')
+        transaction = Transaction()
+
+        for size in SIZES:
+            attribute_set, attributes = create_attribute_set([
+                    ('Attribute %s' % i, 'char', []) for i in range(10)])
+            template = create_template(attribute_set, [])
+            new_template, = Template.copy([template])
+            rows = ProductAttribute.create([{
+                        'template': template.id,
+                        'attribute': attributes[i % len(attributes)].id,
+                        'value_char': str(i),
+                        } for i in range(size)])
+
+            start = time.perf_counter()
+            ProductAttribute.copy(rows, {'template': new_template.id})
+            orm = time.perf_counter() - start
+            report('copy_attributes_orm', size, orm)
+
+            start = time.perf_counter()
+            ProductAttribute.copy_attributes(
+                rows, {template.id: new_template.id})
+            bulk = time.perf_counter() - start
+            report('copy_attributes_bulk', size, bulk)
+
+            self.assertLess(bulk, orm)
+            transaction.rollback()
+
+    @with_transaction()
+    def test_hot_paths(self):
+        "Benchmark the hot paths of the module"
+        pool = Pool()
+        Template = pool.get('product.template')
+        ProductAttribute = pool.get('product.product.attribute')
+        transaction = Transaction()
+
+        attribute_set, templates = seed(TEMPLATES, VARIANTS, ATTRIBUTES)
+        attribute_ids = [a.id for a in ProductAttribute.search([])]
+        size = len(attribute_ids)
+
+        transaction.cache.clear()
+        with self.assertThreshold('update_attributes_values', size):
+            Template.update_attributes_values(Template.browse(templates))
+
+        transaction.cache.clear()
+        with self.assertThreshold('read_value', size):
+            ProductAttribute.read(attribute_ids, ['attribute', 'value'])
+
+        transaction.cache.clear()
+        with self.assertThreshold('search_attribute_set', size):
+            ProductAttribute.search([
+                    ('attribute_set', '=', attribute_set.id),
+                    ])
+
+        transaction.cache.clear()
+        with self.assertThreshold('on_change_attribute_set', 1):
+            template = Template()
+            template.attributes = []
+            template.attribute_set = attribute_set
+            template.on_change_attribute_set()
+
+        transaction.cache.clear()
+        with self.assertThreshold('copy', size):
+            Template.copy(Template.browse(templates))
+
+    @with_transaction()
+    def test_facet_counts(self):
+        "Benchmark facet counts on FACET_ROWS attribute rows"
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        product = Product.__table__()
+        table = ProductAttribute.__table__()
+
+        attribute_set, (color, size, width) = create_attribute_set([
+                ('Color', 'selection', ['Color %s' % i for i in range(20)]),
+                ('Size', 'selection', ['Size %s' % i for i in range(10)]),
+                ('Width', 'integer', []),
+                ])
+        template = create_template(attribute_set, [], variants=0)
+
+        # The rows are inserted with SQL as the ORM would take hours
+        columns = [product.template, product.active,
+            product.create_uid, product.create_date]
+        for sub_rows in grouped_slice(range(FACET_ROWS // 3),
+                backend.MAX_QUERY_PARAMS // len(columns)):
+            cursor.execute(*product.insert(columns, [
+                        [template.id, True, 0, CurrentTimestamp()]
+                        for _ in sub_rows]))
+        cursor.execute(*product.select(product.id,
+                where=product.template == template.id))
+        product_ids = [i for i, in cursor]
+        columns = [table.template, table.template_attribute_set,
+            table.product, table.attribute, table.value_selection,
+            table.value_integer, table.value_sort,
+            table.create_uid, table.create_date]
+        for sub_ids in grouped_slice(product_ids,
+                backend.MAX_QUERY_PARAMS // len(columns) // 3):
+            values = []
+            for product_id in sub_ids:
+                common = [template.id, attribute_set.id, product_id]
+                values.extend([
+                        common + [color.id,
+                            color.selection[product_id % 20].id,
+                            None, None, 0, CurrentTimestamp()],
+                        common + [size.id,
+                            size.selection[product_id % 10].id,
+                            None, None, 0, CurrentTimestamp()],
+                        common + [width.id, None,
+                            product_id % 100, product_id % 100,
+                            0, CurrentTimestamp()],
+                        ])
+            cursor.execute(*table.insert(columns, values))
+        rows = len(product_ids) * 3
+
+        transaction.cache.clear()
+        with self.assertThreshold('facet_counts', rows):
+            counts = ProductAttribute.facet_counts(
+                [('template', '=', template.id)], [color, size, width],
+                buckets={width.id: 10})
+        self.assertEqual(sum(counts[color.id].values()), len(product_ids))
+        self.assertEqual(len(counts[width.id]), 10)
@@ -1,14 +1,1092 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import io
+from decimal import Decimal
+
+from jinja2.exceptions import SecurityError
+from sql import Null
+
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.model import Index
+from trytond.model.exceptions import (
+    RequiredValidationError, ValidationError)
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.product_attribute_strict import snapshot
+from trytond.modules.product_attribute_strict.instrument import (
+    instrumentation)
+from trytond.modules.product_attribute_strict.product import (
+    FormatTemplate, TemplateCache, render_pool)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_attribute_set(attributes, field_templates=None):
+    "Create an attribute set with attributes of the given names and types"
+    pool = Pool()
+    AttributeSet = pool.get('product.attribute.set')
+    Attribute = pool.get('product.attribute')
+
+    attributes = Attribute.create([{
+                'name': name,
+                'type_': type_,
+                'selection': [('create', [{'name': o} for o in options])],
+                } for name, type_, options in attributes])
+    attribute_set, = AttributeSet.create([{
+                'name': 'Set',
+                'fill_on_selection': True,
+                'use_templates': bool(field_templates),
+                'attributes': [('add', [a.id for a in attributes])],
+                'jinja_templates': [('create', [{
+                                'field_': field_,
+                                'jinja_template': expression,
+                                } for field_, expression in (
+                                field_templates or [])])],
+                }])
+    return attribute_set, attributes
+
+
+def create_template(attribute_set, values, variants=1):
+    "Create a template with variants and template-level attribute values"
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': 'Product',
+                'default_uom': unit.id,
+                'attribute_set': attribute_set.id,
+                'products': [('create', [{}] * variants)],
+                'attributes': [('create', [dict(attribute=a.id, **v)
+                                for a, v in values])],
+                }])
+    return template
 
 
 class ProductAttributeStrictTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ProductAttributeStrict module'
     module = 'product_attribute_strict'
 
+    def test_template_cache(self):
+        "Test compiled template cache"
+        cache = TemplateCache(2)
+
+        template = cache.get('{{ Brand }}-{{ Size }}')
+        self.assertEqual(template.render({'Brand': 'A', 'Size': 'M'}), 'A-M')
+        self.assertIs(cache.get('{{ Brand }}-{{ Size }}'), template)
+        cache.get('{{ Brand }}')
+        cache.get('{{ Size }}')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3, 'size': 2})
+
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_template_cache_compile(self):
+        "Test compilation of simple templates and sandbox"
+        cache = TemplateCache(10)
+        values = {'Brand': 'A', 'Size': None, 'Width': 42}
+
+        for expression in [
+                '{{ Brand }}-{{ Size }}',
+                'Brand: {{Brand}} {{ Width }} {{ Missing }}\n',
+                'Text',
+                '',
+                ]:
+            with self.subTest(expression=expression):
+                template = cache.get(expression)
+                self.assertIsInstance(template, FormatTemplate)
+                self.assertEqual(
+                    template.render(values),
+                    cache.environment.from_string(expression).render(values))
+
+        template = cache.get('{{ Brand|lower }}')
+        self.assertNotIsInstance(template, FormatTemplate)
+        self.assertEqual(template.render(values), 'a')
+
+        with self.assertRaises(SecurityError):
+            cache.get('{{ Brand.__class__.__mro__ }}').render(values)
+
+    @with_transaction()
+    def test_update_attributes_values(self):
+        "Test update attributes values"
+        pool = Pool()
+        Template = pool.get('product.template')
+
+        attribute_set, (brand, width) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Width', 'numeric', []),
+                ], [
+                ('template,name', '{{ Brand }} {{ Width }}'),
+                ])
+        templates = [create_template(attribute_set, [
+                    (brand, {'value_char': 'ACME'}),
+                    (width, {'value_numeric': Decimal(i)}),
+                    ])
+            for i in range(3)]
+
+        template = Template(templates[0].id)
+        self.assertEqual(template._update_attributes_values(), [])
+        self.assertEqual(template.name, 'ACME 0')
+
+        Template.update_attributes_values(templates)
+
+        for i, template in enumerate(templates):
+            self.assertEqual(template.name, 'ACME %s' % i)
+
+    @with_transaction()
+    def test_update_attributes_values_variant(self):
+        "Test update attributes values with variant attributes"
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, (brand, size) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Size', 'char', []),
+                ], [
+                ('template,name', '{{ Brand }}'),
+                ('product,code', '{{ Brand }}-{{ Size }}'),
+                ])
+        template = create_template(attribute_set, [
+                (brand, {'value_char': 'ACME'}),
+                (size, {'value_char': 'S'}),
+                ], variants=4)
+        small, medium, large, other = template.products
+        *_, row_other = ProductAttribute.create([{
+                    'template': template.id,
+                    'product': product.id,
+                    'attribute': size.id,
+                    'value_char': value,
+                    } for product, value in [
+                    (medium, 'M'), (large, 'L'), (other, 'M')]])
+
+        with Transaction().set_context(product_attribute_instrument=True):
+            instrumentation.reset()
+            with instrumentation.measure('update_attributes_values'):
+                template_values, product_values = (
+                    Template._render_attributes_values([template]))
+            renders = instrumentation.stats['render_expression']['calls']
+            instrumentation.reset()
+
+        self.assertEqual(template_values, {template: {'name': 'ACME'}})
+        self.assertEqual(product_values, {
+                small: {'suffix_code': 'ACME-S'},
+                medium: {'suffix_code': 'ACME-M'},
+                large: {'suffix_code': 'ACME-L'},
+                other: {'suffix_code': 'ACME-M'},
+                })
+        self.assertEqual(renders, 4)
+
+        ProductAttribute.write([row_other], {'value_char': 'XL'})
+        Template.update_attributes_values([template])
+        self.assertEqual(
+            [p.code for p in Product.browse(template.products)],
+            ['ACME-S', 'ACME-M', 'ACME-L', 'ACME-XL'])
+        self.assertEqual(
+            Template._render_attributes_values([template]), ({}, {}))
+
+    @with_transaction()
+    def test_render_attributes_values_parallel(self):
+        "Test parallel rendering gives the same values as serial rendering"
+        pool = Pool()
+        Template = pool.get('product.template')
+
+        attribute_set, (brand, width) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Width', 'integer', []),
+                ], [
+                ('template,name', '{{ Brand }} {{ Width }}'),
+                ('product,code', '{{ Brand|upper }}-{{ Width }}'),
+                ])
+        templates = [create_template(attribute_set, [
+                    (brand, {'value_char': 'Brand %s' % (i % 3)}),
+                    (width, {'value_integer': i}),
+                    ], variants=2)
+            for i in range(10)]
+
+        serial = Template._render_attributes_values(templates)
+        process_pool = render_pool(2)
+        parallel = Template._render_attributes_values(
+            templates, process_pool=process_pool)
+
+        self.assertEqual(parallel, serial)
+        self.assertIs(render_pool(2), process_pool)
+        self.assertIsNone(render_pool(1))
+        self.assertEqual(serial[0][templates[4]], {'name': 'Brand 1 4'})
+
+    @with_transaction()
+    def test_queue_attributes_values(self):
+        "Test update attributes values by chunks in the queue"
+        pool = Pool()
+        Template = pool.get('product.template')
+        Queue = pool.get('ir.queue')
+        transaction = Transaction()
+
+        attribute_set, (brand,) = create_attribute_set([
+                ('Brand', 'char', []),
+                ], [
+                ('template,name', '{{ Brand }}'),
+                ])
+        templates = [create_template(
+                    attribute_set, [(brand, {'value_char': 'ACME %s' % i})])
+            for i in range(3)]
+        Template.render_attributes_values(templates)
+        Template.write(templates, {'name': "Manual"})
+
+        with transaction.set_context(product_attribute_queue=True):
+            Template.update_attributes_values(templates)
+        self.assertEqual(len(transaction.tasks), 1)
+        transaction.tasks.clear()
+
+        Template.queue_attributes_values(templates, chunk_size=2)
+        self.assertEqual(len(transaction.tasks), 2)
+        self.assertEqual([t.name for t in templates], ["Manual"] * 3)
+        self.assertTrue(all(t.attributes_stale for t in templates))
+
+        while transaction.tasks:
+            Queue(transaction.tasks.pop()).run()
+        self.assertEqual(
+            [t.name for t in templates], ['ACME 0', 'ACME 1', 'ACME 2'])
+        self.assertFalse(any(t.attributes_stale for t in templates))
+
+    @with_transaction()
+    def test_field_template_syntax(self):
+        "Test syntax of field templates is validated"
+        pool = Pool()
+        FieldTemplate = pool.get('product.attribute.field_template')
+
+        attribute_set, _ = create_attribute_set([
+                ('Brand', 'char', []),
+                ], [
+                ('template,name', '{{ Brand }}'),
+                ])
+        field_template, = attribute_set.jinja_templates
+
+        with self.assertRaises(ValidationError):
+            FieldTemplate.write([field_template], {
+                    'jinja_template': '{{ Brand ',
+                    })
+
+    @with_transaction()
+    def test_update_stale_attributes_values(self):
+        "Test update attributes values of stale templates only"
+        pool = Pool()
+        Template = pool.get('product.template')
+        ProductAttribute = pool.get('product.product.attribute')
+        FieldTemplate = pool.get('product.attribute.field_template')
+
+        attribute_set, (brand,) = create_attribute_set([
+                ('Brand', 'char', []),
+                ], [
+                ('template,name', '{{ Brand }}'),
+                ])
+        template = create_template(
+            attribute_set, [(brand, {'value_char': 'ACME'})])
+        other = create_template(
+            attribute_set, [(brand, {'value_char': 'Other'})])
+        self.assertTrue(template.attributes_stale)
+
+        Template.update_stale_attributes_values()
+        self.assertEqual([template.name, other.name], ['ACME', 'Other'])
+        self.assertFalse(template.attributes_stale)
+        self.assertFalse(other.attributes_stale)
+
+        Template.write([template, other], {'name': "Manual"})
+        attribute, = template.attributes
+        ProductAttribute.write([attribute], {'value_char': 'Foo'})
+        self.assertTrue(template.attributes_stale)
+        self.assertFalse(other.attributes_stale)
+
+        Template.update_stale_attributes_values()
+        self.assertEqual([template.name, other.name], ['Foo', "Manual"])
+
+        field_template, = attribute_set.jinja_templates
+        FieldTemplate.write([field_template], {
+                'jinja_template': '{{ Brand }}!',
+                })
+        self.assertTrue(other.attributes_stale)
+
+        Template.update_stale_attributes_values([other])
+        self.assertEqual([template.name, other.name], ['Foo', 'Other!'])
+        self.assertTrue(template.attributes_stale)
+
+    @with_transaction()
+    def test_attribute_value(self):
+        "Test attribute value getter"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, attributes = create_attribute_set([
+                ('Boolean', 'boolean', []),
+                ('Integer', 'integer', []),
+                ('Char', 'char', []),
+                ('Float', 'float', []),
+                ('Numeric', 'numeric', []),
+                ('Date', 'date', []),
+                ('DateTime', 'datetime', []),
+                ('Selection', 'selection', ['Red', 'Blue']),
+                ])
+        selection = attributes[-1]
+        template = create_template(attribute_set, zip(attributes, [
+                    {'value_boolean': True},
+                    {'value_integer': 42},
+                    {'value_char': 'Foo'},
+                    {'value_float': 1.5},
+                    {'value_numeric': Decimal('2.50')},
+                    {'value_date': dt.date(2020, 1, 31)},
+                    {'value_datetime': dt.datetime(2020, 1, 31, 12, 30)},
+                    {'value_selection': selection.selection[1].id},
+                    ]))
+
+        rows = ProductAttribute.browse(template.attributes)
+        self.assertEqual([r.value for r in rows[1:]], [
+                '42', 'Foo', '1.5', '2.50', '01/31/2020',
+                '01/31/2020\xa012:30:00', 'Blue'])
+        self.assertEqual(
+            [r.value for r in rows],
+            [r.on_change_with_value() for r in rows])
+
+    @with_transaction()
+    def test_attribute_value_datetime_timezone(self):
+        "Test datetime attribute value in the company timezone"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+
+        company = create_company()
+        company.timezone = 'Europe/Brussels'
+        company.save()
+        attribute_set, (datetime,) = create_attribute_set([
+                ('DateTime', 'datetime', []),
+                ])
+        template = create_template(attribute_set, [
+                (datetime, {'value_datetime': dt.datetime(2020, 7, 1, 12)}),
+                ])
+        row, = template.attributes
+
+        with set_company(company):
+            self.assertEqual(
+                ProductAttribute(row.id).value, '07/01/2020\xa014:00:00')
+            company.timezone = 'UTC'
+            company.save()
+            self.assertEqual(
+                ProductAttribute(row.id).value, '07/01/2020\xa012:00:00')
+
+    @with_transaction()
+    def test_get_attribute_values(self):
+        "Test typed attribute values of templates and products"
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, (brand, width, color) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Width', 'numeric', []),
+                ('Color', 'selection', ['Red', 'Blue']),
+                ])
+        red, blue = color.selection
+
+        def create(count):
+            templates = []
+            for i in range(count):
+                template = create_template(attribute_set, [
+                        (brand, {'value_char': 'ACME'}),
+                        (width, {'value_numeric': Decimal(i)}),
+                        (color, {'value_selection': red.id}),
+                        ], variants=2)
+                ProductAttribute.create([{
+                            'template': template.id,
+                            'product': template.products[0].id,
+                            'attribute': color.id,
+                            'value_selection': blue.id,
+                            }])
+                templates.append(template)
+            return templates
+
+        templates = create(2)
+        blue_variant, red_variant = templates[1].products
+
+        self.assertEqual(
+            templates[1].attribute_values,
+            {'Brand': 'ACME', 'Width': Decimal(1), 'Color': 'Red'})
+        self.assertEqual(
+            blue_variant.attribute_values,
+            {'Brand': 'ACME', 'Width': Decimal(1), 'Color': 'Blue'})
+        self.assertEqual(
+            red_variant.attribute_values,
+            {'Brand': 'ACME', 'Width': Decimal(1), 'Color': 'Red'})
+
+        products = [p for t in templates for p in t.products]
+        more_products = products + [p for t in create(4) for p in t.products]
+        counts = []
+        for records in [products, more_products]:
+            Transaction().cache.clear()
+            with instrumentation.count_queries() as queries:
+                Product.get_attribute_values(Product.browse(records))
+                Template.get_attribute_values(
+                    Template.browse({p.template for p in records}))
+            counts.append(queries.count)
+        self.assertLessEqual(counts[1], counts[0])
+
+    @with_transaction()
+    def test_facet_counts(self):
+        "Test facet counts of attribute values"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, (color, width, promo) = create_attribute_set([
+                ('Color', 'selection', ['Red', 'Blue']),
+                ('Width', 'numeric', []),
+                ('Promo', 'boolean', []),
+                ])
+        red, blue = color.selection
+        templates = [create_template(attribute_set, [
+                    (color, {'value_selection': red.id}),
+                    (width, {'value_numeric': Decimal(i * 15)}),
+                    (promo, {'value_boolean': bool(i % 2)}),
+                    ], variants=2)
+            for i in range(3)]
+        ProductAttribute.create([{
+                    'template': t.id,
+                    'product': t.products[0].id,
+                    'attribute': color.id,
+                    'value_selection': blue.id,
+                    } for t in templates[:2]])
+
+        self.assertEqual(
+            ProductAttribute.facet_counts([], [color, width, promo]), {
+                color.id: {red.id: 4, blue.id: 2},
+                width.id: {Decimal(0): 2, Decimal(15): 2, Decimal(30): 2},
+                promo.id: {False: 4, True: 2},
+                })
+        self.assertEqual(
+            ProductAttribute.facet_counts(
+                [('template', '!=', templates[0].id)], [color, width],
+                buckets={width.id: 20}), {
+                color.id: {red.id: 3, blue.id: 1},
+                width.id: {0: 2, 20: 2},
+                })
+
+    @with_transaction()
+    def test_strict_violations(self):
+        "Test bulk check of attribute consistency"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+        table = ProductAttribute.__table__()
+
+        attribute_set, (color, brand) = create_attribute_set([
+                ('Color', 'selection', ['Red']),
+                ('Brand', 'char', []),
+                ])
+        _, (size,) = create_attribute_set([
+                ('Size', 'selection', ['M']),
+                ])
+        red, = color.selection
+        medium, = size.selection
+        template = create_template(attribute_set, [
+                (color, {'value_selection': red.id}),
+                (brand, {'value_char': 'ACME'}),
+                ])
+        other = create_template(attribute_set, [])
+        row_color, row_brand = template.attributes
+
+        self.assertEqual(ProductAttribute.audit_strict(), [])
+
+        # Corrupt the rows with SQL as the ORM refuses to
+        cursor.execute(*table.update(
+                [table.value_selection], [medium.id],
+                where=table.id == row_color.id))
+        cursor.execute(*table.update(
+                [table.value_char, table.product], ['', other.products[0].id],
+                where=table.id == row_brand.id))
+        cursor.execute(*table.insert(
+                [table.template, table.attribute, table.value_selection],
+                [[template.id, size.id, medium.id]]))
+
+        violations = ProductAttribute.audit_strict(chunk_size=1)
+        row_size, = ProductAttribute.search([('attribute', '=', size.id)])
+        self.assertEqual(sorted(violations), sorted([
+                    (row_color.id, 'selection'),
+                    (row_brand.id, 'template'),
+                    (row_brand.id, 'value'),
+                    (row_size.id, 'attribute_set'),
+                    ]))
+        self.assertEqual(
+            ProductAttribute.strict_violations([row_color.id]),
+            [(row_color.id, 'selection')])
+
+        with self.assertRaises(ValidationError):
+            ProductAttribute.write([row_brand], {'value_char': 'ACME'})
+        ProductAttribute.write([row_brand], {
+                'value_char': 'ACME',
+                'product': template.products[0].id,
+                })
+
+        with self.assertRaises(RequiredValidationError):
+            ProductAttribute.create([{
+                        'attribute': brand.id,
+                        'value_char': 'ACME',
+                        }])
+        with self.assertRaises(RequiredValidationError):
+            ProductAttribute.create([{
+                        'template': template.id,
+                        'value_char': 'ACME',
+                        }])
+        with self.assertRaises(ValidationError):
+            ProductAttribute.write([row_color], {'value_selection': medium.id})
+        with self.assertRaises(ValidationError):
+            ProductAttribute.create([{
+                        'template': other.id,
+                        'attribute': size.id,
+                        'value_selection': medium.id,
+                        }])
+
+    @with_transaction()
+    def test_product_attributes_used(self):
+        "Test attributes used by templates and variants"
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, (brand, size) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Size', 'integer', []),
+                ])
+        template = create_template(
+            attribute_set, [(brand, {'value_char': 'ACME'})], variants=2)
+        other = create_template(
+            attribute_set, [(brand, {'value_char': 'Other'})])
+        row_brand, = template.attributes
+        row_other, = other.attributes
+        product1, product2 = template.products
+        row_size, = ProductAttribute.create([{
+                    'template': template.id,
+                    'product': product1.id,
+                    'attribute': size.id,
+                    'value_integer': 42,
+                    }])
+
+        self.assertEqual(
+            list(Template.product_attributes_used([template, other])), [
+                (template, row_brand),
+                (template, row_size),
+                (other, row_other),
+                ])
+        self.assertEqual(
+            list(Product.product_attributes_used([product1, product2])), [
+                (product1, row_size),
+                (product1, row_brand),
+                (product2, row_brand),
+                ])
+        self.assertEqual(
+            list(product1.product_attribute_used), [row_size, row_brand])
+
+    @with_transaction()
+    def test_attribute_summary(self):
+        "Test attribute summary of variants"
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+        Option = pool.get('product.attribute.selection_option')
+        cursor = Transaction().connection.cursor()
+        table = Product.__table__()
+
+        with Transaction().set_context(product_attribute_summary=True):
+            attribute_set, (color, size) = create_attribute_set([
+                    ('Color', 'selection', ['Red', 'Blue']),
+                    ('Size', 'char', []),
+                    ])
+            red, blue = color.selection
+            template = create_template(attribute_set, [
+                    (color, {'value_selection': red.id}),
+                    ], variants=2)
+            product1, product2 = template.products
+            row, = ProductAttribute.create([{
+                        'template': template.id,
+                        'product': product1.id,
+                        'attribute': size.id,
+                        'value_char': 'M',
+                        }])
+
+            self.assertEqual(
+                [p.attribute_summary
+                    for p in Product.browse(template.products)],
+                ['Color: Red, Size: M', 'Color: Red'])
+
+            Option.write([red], {'name': 'Crimson'})
+            ProductAttribute.write([row], {'product': product2.id})
+            self.assertEqual(
+                [p.attribute_summary
+                    for p in Product.browse(template.products)],
+                ['Color: Crimson', 'Color: Crimson, Size: M'])
+            self.assertEqual(Product.search([
+                        ('attribute_summary', 'ilike', '%Size: M%'),
+                        ]), [product2])
+
+            ProductAttribute.delete([row])
+            cursor.execute(*table.update(
+                    [table.attribute_summary], [None]))
+            Product.rebuild_attribute_summary(chunk_size=1)
+            self.assertEqual(
+                [p.attribute_summary
+                    for p in Product.browse(template.products)],
+                ['Color: Crimson', 'Color: Crimson'])
+
+            Attribute.write([color], {'display_name': 'Colour'})
+            self.assertEqual(
+                [p.attribute_summary
+                    for p in Product.browse(template.products)],
+                ['Colour: Crimson', 'Colour: Crimson'])
+
+    @with_transaction()
+    def test_search_value(self):
+        "Test search on attribute value"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        SelectionOption = pool.get('product.attribute.selection_option')
+        Lang = pool.get('ir.lang')
+
+        attribute_set, (color, width, date, promo) = create_attribute_set([
+                ('Color', 'selection', ['Red', 'Blue']),
+                ('Width', 'numeric', []),
+                ('Date', 'date', []),
+                ('Promo', 'boolean', []),
+                ])
+        red, blue = color.selection
+        for option, value in [(red, 30), (blue, 50)]:
+            create_template(attribute_set, [
+                    (color, {'value_selection': option.id}),
+                    (width, {'value_numeric': Decimal(value)}),
+                    (date, {'value_date': dt.date(2020, 1, value // 10)}),
+                    (promo, {'value_boolean': True}),
+                    ])
+
+        def search(*clause):
+            return sorted(a.value for a in ProductAttribute.search([
+                        ('value',) + clause]))
+
+        self.assertEqual(search('=', 'Red'), ['Red'])
+        self.assertEqual(search('in', ['Red', 'Blue']), ['Blue', 'Red'])
+        self.assertEqual(search('ilike', 'bl%'), ['Blue'])
+        self.assertEqual(search('=', 30), ['30'])
+        self.assertEqual(search('>', 40), ['50'])
+        self.assertEqual(search('<=', '50'), ['30', '50'])
+        self.assertEqual(search('>', dt.date(2020, 1, 4)), ['01/05/2020'])
+        self.assertEqual(search('=', '1'), [])
+        self.assertEqual(len(search('=', True)), 2)
+        self.assertFalse(
+            any(a.write_date for a in ProductAttribute.search([])))
+
+        french, = Lang.search([('code', '=', 'fr')])
+        french.translatable = True
+        french.save()
+        with Transaction().set_context(language='fr'):
+            SelectionOption.write([blue], {'name': 'Bleu'})
+            self.assertEqual(search('=', 'Bleu'), ['Bleu'])
+            self.assertEqual(search('=', 'Blue'), [])
+            self.assertEqual(search('=', 30), ['30'])
+
+        SelectionOption.write([red], {'name': 'Crimson'})
+        self.assertEqual(search('=', 'Crimson'), ['Crimson'])
+
+        ProductAttribute.write(ProductAttribute.search([]), {
+                'value_search': None,
+                'value_sort': None,
+                })
+        self.assertEqual(search('=', 'Blue'), [])
+        ProductAttribute.backfill_value_search(batch_size=2)
+        self.assertEqual(search('=', 'Blue'), ['Blue'])
+
+    @with_transaction()
+    def test_attribute_indexes(self):
+        "Test attribute lookups use the declared indexes"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        AttributeSet = pool.get('product.attribute-product.attribute-set')
+        cursor = Transaction().connection.cursor()
+
+        if backend.name == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        else:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            explain = 'EXPLAIN '
+
+        def index_name(Model, index):
+            table_h = Model.__table_handler__()
+            translator = table_h.index_translator_for(index)
+            name, _, _ = translator.definition(index)
+            name = '_'.join([table_h.table_name, name])
+            return 'idx_' + table_h.convert_name(name, reserved=len('idx_'))
+
+        attribute = ProductAttribute.__table__()
+        attribute_set = AttributeSet.__table__()
+        for Model, index, query in [
+                (ProductAttribute,
+                    Index(attribute,
+                        (attribute.template, Index.Equality()),
+                        (attribute.attribute, Index.Equality()),
+                        where=attribute.product == Null),
+                    attribute.select(attribute.id,
+                        where=(attribute.template == 1)
+                        & (attribute.attribute == 1)
+                        & (attribute.product == Null))),
+                (ProductAttribute,
+                    Index(attribute,
+                        (attribute.value_selection, Index.Equality()),
+                        where=attribute.value_selection != Null),
+                    attribute.select(attribute.id,
+                        where=attribute.value_selection == 1)),
+                (ProductAttribute,
+                    Index(attribute,
+                        (attribute.attribute, Index.Equality()),
+                        (attribute.value_sort, Index.Range())),
+                    attribute.select(attribute.id,
+                        where=(attribute.attribute == 1)
+                        & (attribute.value_sort > 10))),
+                (AttributeSet,
+                    Index(attribute_set,
+                        (attribute_set.attribute_set, Index.Equality()),
+                        (attribute_set.attribute, Index.Equality())),
+                    attribute_set.select(attribute_set.id,
+                        where=(attribute_set.attribute_set == 1)
+                        & (attribute_set.attribute == 1))),
+                ]:
+            self.assertIn(index, Model._sql_indexes)
+            with self.subTest(query=str(query)):
+                query, params = tuple(query)
+                cursor.execute(explain + query, params)
+                plan = ' '.join(str(r) for r in cursor.fetchall())
+                self.assertIn(index_name(Model, index), plan)
+
+    @with_transaction()
+    def test_search_attribute_set(self):
+        "Test search on attribute set"
+        pool = Pool()
+        Template = pool.get('product.template')
+        AttributeSet = pool.get('product.attribute.set')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, (brand,) = create_attribute_set([
+                ('Brand', 'char', []),
+                ])
+        template = create_template(attribute_set, [
+                (brand, {'value_char': 'ACME'}),
+                ])
+        attribute, = template.attributes
+        self.assertEqual(attribute.attribute_set, attribute_set)
+        self.assertEqual(ProductAttribute.search([
+                    ('attribute_set.name', '=', 'Set'),
+                    ]), [attribute])
+
+        other_set, = AttributeSet.copy([attribute_set], {'name': 'Other'})
+        Template.write([template], {'attribute_set': other_set.id})
+        self.assertEqual(ProductAttribute.search([
+                    ('attribute_set', '=', other_set.id),
+                    ]), [attribute])
+        self.assertEqual(ProductAttribute.search([
+                    ('attribute_set', '=', attribute_set.id),
+                    ]), [])
+
+    @with_transaction()
+    def test_import_export_csv(self):
+        "Test import and export attributes as CSV"
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, (color, width, date) = create_attribute_set([
+                ('Color', 'selection', ['Red', 'Blue']),
+                ('Width', 'numeric', []),
+                ('Date', 'date', []),
+                ])
+        template = create_template(attribute_set, [
+                (width, {'value_numeric': Decimal(10)}),
+                ])
+        product, = template.products
+        Product.write([product], {'suffix_code': 'P1'})
+
+        ProductAttribute.import_csv(io.StringIO(
+                'code,attribute,value\n'
+                'P1,Color,Red\n'
+                '\n'
+                'P1,Width,40.5\n'
+                'P1,Width,42\n'
+                'P1,Date,2020-01-31\n'), chunk_size=2)
+
+        self.assertEqual(
+            sorted((a.attribute.name, a.value) for a in product.attributes),
+            [('Color', 'Red'), ('Date', '01/31/2020'), ('Width', '42')])
+
+        output = io.StringIO()
+        ProductAttribute.export_csv(output, chunk_size=2)
+        self.assertEqual(output.getvalue().splitlines(), [
+                'code,attribute,value',
+                'P1,Color,Red',
+                'P1,Width,42',
+                'P1,Date,2020-01-31',
+                ])
+
+        output.seek(0)
+        ProductAttribute.import_csv(output)
+        self.assertEqual(ProductAttribute.search([], count=True), 4)
+
+        with self.assertRaises(UserError):
+            ProductAttribute.import_csv(io.StringIO('P1,Color\n'),
+                header=False)
+
+        with self.assertRaises(UserError):
+            ProductAttribute.import_csv(io.StringIO('P1,Color,Green\n'),
+                header=False)
+        with self.assertRaises(UserError):
+            ProductAttribute.import_csv(io.StringIO('P1,Width,wide\n'),
+                header=False)
+
+    @with_transaction()
+    def test_upsert_options(self):
+        "Test upsert and cache of selection options"
+        pool = Pool()
+        Option = pool.get('product.attribute.selection_option')
+
+        _, (color,) = create_attribute_set([
+                ('Color', 'selection', ['Red', 'Blue']),
+                ])
+        red, blue = color.selection
+        self.assertEqual(Option.get_ids(color.id), {
+                'Red': red.id, 'Blue': blue.id})
+
+        ids = Option.upsert_options(color, ['Blue', 'Green', 'Red', 'Green'])
+        green, = Option.search([('name', '=', 'Green')])
+        self.assertEqual(ids, [blue.id, green.id, red.id, green.id])
+        self.assertEqual(Option.get_names(color.id), {
+                red.id: 'Red', blue.id: 'Blue', green.id: 'Green'})
+
+        Option.write([green], {'name': 'Lime'})
+        Option.delete([red])
+        self.assertEqual(Option.get_ids(color.id), {
+                'Blue': blue.id, 'Lime': green.id})
+        self.assertEqual(
+            Option.upsert_options(color, ['Blue']), [blue.id])
+        self.assertEqual(Option.search([], count=True), 2)
+
+    @with_transaction()
+    def test_export_snapshot(self):
+        "Test export and read of attributes snapshot"
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, attributes = create_attribute_set([
+                ('Boolean', 'boolean', []),
+                ('Integer', 'integer', []),
+                ('Char', 'char', []),
+                ('Float', 'float', []),
+                ('Numeric', 'numeric', []),
+                ('Date', 'date', []),
+                ('DateTime', 'datetime', []),
+                ('Selection', 'selection', ['Red', 'Blue']),
+                ])
+        selection = attributes[-1]
+        values = [True, 42, 'Fôo', 1.5, Decimal('2.50'), dt.date(2020, 1, 31),
+            dt.datetime(2020, 1, 31, 12, 30, 15), 'Blue']
+        template = create_template(attribute_set, zip(attributes, [
+                    {'value_boolean': True},
+                    {'value_integer': 42},
+                    {'value_char': 'Fôo'},
+                    {'value_float': 1.5},
+                    {'value_numeric': Decimal('2.50')},
+                    {'value_date': dt.date(2020, 1, 31)},
+                    {'value_datetime': values[6]},
+                    {'value_selection': selection.selection[1].id},
+                    ]))
+        product, = template.products
+        row, = ProductAttribute.create([{
+                    'template': template.id,
+                    'product': product.id,
+                    'attribute': attributes[1].id,
+                    'value_integer': 7,
+                    }])
+        table = ProductAttribute.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+                [table.value_integer], [None], where=table.id == row.id))
+
+        file = io.BytesIO()
+        ProductAttribute.export_snapshot(file, chunk_size=3)
+        file.seek(0)
+        chunks = list(snapshot.read(file))
+
+        self.assertEqual([len(c) for c in chunks], [3, 3, 3])
+        rows = [r for c in chunks for r in c.rows()]
+        self.assertEqual(rows, [
+                (a.id, template.id, None, a.attribute.name, v)
+                for a, v in zip(template.attributes[:8], values)] + [
+                (row.id, template.id, product.id, 'Integer', None)])
+
+        file = io.BytesIO()
+        ProductAttribute.export_snapshot(
+            file, domain=[('product', '=', product.id)])
+        file.seek(0)
+        chunk, = snapshot.read(file)
+        self.assertEqual(
+            chunk.attributes, [(attributes[1].id, 'Integer', 'integer')])
+
+    @with_transaction()
+    def test_attribute_set_cache(self):
+        "Test cache of attribute set attributes"
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        Attribute = pool.get('product.attribute')
+        Template = pool.get('product.template')
+
+        attribute_set, (brand, width) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Width', 'integer', []),
+                ])
+        self.assertEqual(AttributeSet.get_attributes_types(attribute_set.id),
+            ((brand.id, 'char'), (width.id, 'integer')))
+
+        Attribute.write([width], {'type_': 'float'})
+        self.assertEqual(Attribute.get_type(width.id), 'float')
+        AttributeSet.write([attribute_set], {
+                'attributes': [('remove', [brand.id])],
+                })
+        self.assertEqual(AttributeSet.get_attributes_types(attribute_set.id),
+            ((width.id, 'float'),))
+
+        template = Template()
+        template.attributes = []
+        template.attribute_set = attribute_set
+        template.on_change_attribute_set()
+        attribute, = template.attributes
+        self.assertEqual(attribute.attribute, width)
+        self.assertEqual(attribute.attribute_type, 'float')
+
+    @with_transaction()
+    def test_apply_attribute_set(self):
+        "Test apply attribute set on templates"
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        Template = pool.get('product.template')
+        ApplyStart = pool.get('product.attribute.set.apply.start')
+
+        attribute_set, (brand, width) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Width', 'integer', []),
+                ])
+        other_set, = AttributeSet.create([{
+                    'name': 'Other',
+                    'attributes': [('add', [width.id])],
+                    }])
+        templates = [
+            create_template(attribute_set, [(brand, {'value_char': 'ACME'})]),
+            create_template(attribute_set, [(width, {'value_integer': 1})]),
+            ]
+
+        start = ApplyStart(attribute_set=other_set)
+        start.on_change_attribute_set()
+        value, = start.values
+        self.assertEqual(value.attribute, width)
+        value.value_integer = 10
+        Template.apply_attribute_set(
+            templates, other_set, {width.id: value.get_values()})
+
+        self.assertEqual(
+            [t.attribute_set for t in templates], [other_set, other_set])
+        self.assertEqual(
+            [[(a.attribute, a.value) for a in t.attributes]
+                for t in templates],
+            [[(width, '10')], [(width, '1')]])
+
+    @with_transaction()
+    def test_copy_attributes(self):
+        "Test copy templates and variants with attributes"
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        es, = Lang.search([('code', '=', 'es')])
+        Lang.write([es], {'translatable': True})
+        attribute_set, (brand, width) = create_attribute_set([
+                ('Brand', 'char', []),
+                ('Width', 'integer', []),
+                ])
+        template = create_template(attribute_set, [
+                (brand, {'value_char': 'Hello'}),
+                ])
+        product, = template.products
+        ProductAttribute.create([{
+                    'template': template.id,
+                    'product': product.id,
+                    'attribute': width.id,
+                    'value_integer': 42,
+                    }])
+        with Transaction().set_context(language='es'):
+            ProductAttribute.write(
+                [a for a in template.attributes if a.attribute == brand],
+                {'value_char': 'Hola'})
+
+        new_template, = Template.copy([template])
+        new_product, = new_template.products
+
+        self.assertEqual(
+            sorted((a.attribute.name, a.product, a.value)
+                for a in new_template.attributes),
+            [('Brand', None, 'Hello'), ('Width', new_product, '42')])
+        with Transaction().set_context(language='es'):
+            self.assertEqual(ProductAttribute.search([
+                        ('template', '=', new_template.id),
+                        ('attribute', '=', brand.id),
+                        ])[0].value_char, 'Hola')
+        self.assertEqual(ProductAttribute.search([
+                    ('attribute_set', '=', attribute_set.id),
+                    ('value', '=', 'Hello'),
+                    ], count=True), 2)
+
+        other_set, (color,) = create_attribute_set([('Color', 'char', [])])
+        other = create_template(other_set, [(color, {'value_char': 'Red'})])
+        with self.assertRaises(ValidationError):
+            Product.copy([new_product], {'template': other.id})
+
+    @with_transaction()
+    def test_instrumentation(self):
+        "Test instrumentation of attribute operations"
+        pool = Pool()
+        Template = pool.get('product.template')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attribute_set, (brand,) = create_attribute_set(
+            [('Brand', 'char', [])], [('template,name', '{{ Brand }}')])
+        template = create_template(
+            attribute_set, [(brand, {'value_char': 'ACME'})], variants=2)
+        instrumentation.reset()
+
+        Template.update_attributes_values([template])
+        attribute_set.render_expression_record(
+            '{{ Brand }}', {'Brand': 'ACME'})
+        self.assertFalse(instrumentation.stats)
+
+        with Transaction().set_context(product_attribute_instrument=True):
+            Template.update_attributes_values([template])
+            ProductAttribute.read(
+                [a.id for a in template.attributes], ['value'])
+        stats = instrumentation.stats
+        self.assertEqual(stats['update_attributes_values']['calls'], 1)
+        self.assertGreater(stats['update_attributes_values']['queries'], 0)
+        self.assertEqual(stats['update_attributes_values']['renders'], 1)
+        self.assertEqual(stats['render_expression']['calls'], 1)
+        self.assertGreaterEqual(stats['value']['rows'], 1)
+        instrumentation.reset()
+
 
 del ModuleTestCase
+